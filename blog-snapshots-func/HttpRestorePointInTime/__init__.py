@@ -0,0 +1,36 @@
+import logging
+
+import azure.functions as func
+import json
+
+from ..shared_code.backup_naming import parse_timestamp
+from ..shared_code.clients import get_source_client, get_backup_client
+from ..shared_code.metrics import InvocationMetrics
+from ..shared_code.restore import restore_point_in_time
+
+def main(req: func.HttpRequest) -> func.HttpResponse:
+    # The restore runs within the HTTP request, which is cut off after 230 seconds. Larger restores are split by
+    # the caller in prefixes, dry_run=true returns the number of blobs of a prefix to size them.
+    logging.info('Python HTTP trigger function processed a request.')
+    invocation = InvocationMetrics("HttpRestorePointInTime")
+    container_name = req.params.get('container')
+    # prefix=<folder>/ restores the blobs of a folder (default whole container)
+    prefix = req.params.get('prefix', "")
+    # timestamp=<ISO 8601 timestamp> is the point in time to restore to
+    timestamp = parse_timestamp(req.params.get('timestamp'))
+    if not container_name or timestamp is None:
+        return func.HttpResponse("parameters container and timestamp are required", status_code=400)
+    # source=snapshots (default) restores from snapshots in the source account, source=backup from the backup account
+    from_backup = req.params.get('source', "snapshots") == "backup"
+    # target_container=<container> restores a complete copy of the blobs next to the data instead of in place
+    container_name_target = req.params.get('target_container')
+    # dry_run=true only returns the number of blobs that would be restored
+    dry_run = req.params.get('dry_run', "false").lower() == "true"
+
+    result = restore_point_in_time(get_source_client(), get_backup_client(), container_name, prefix, timestamp,
+                                   from_backup, container_name_target, dry_run)
+
+    response = {"status": "ok" if result.failed == 0 else "partial", "dry_run": dry_run, "source": "backup" if from_backup else "snapshots"}
+    response.update(result.to_dict())
+    response["metrics"] = invocation.log()
+    return func.HttpResponse(json.dumps(response), mimetype="application/json")
@@ -1,56 +1,99 @@
 import logging
-import os
 
 import azure.functions as func
-from azure.identity import DefaultAzureCredential, ClientSecretCredential
-from azure.storage.blob import BlobServiceClient
-from azure.storage.queue import QueueService, QueueMessageFormat
-from datetime import datetime
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceModifiedError, ResourceNotFoundError
+import json
+
+from ..shared_code.backup_naming import normalize_etag, parse_timestamp
+from ..shared_code.backup_queue import BackupRequestQueue, get_queue_client
+from ..shared_code.checkpoint import create_checkpoint_store
+from ..shared_code.clients import get_source_client
+from ..shared_code.listing import iter_blob_records
+from ..shared_code.metrics import InvocationMetrics
+from ..shared_code.snapshot_index import load_snapshot_index, save_snapshot_index
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a request.')
+    invocation = InvocationMetrics("HttpSnapshotIncBackupContainerProducer")
     container_name = req.params.get('container')
+    # prefix=<folder>/,<folder>/ only lists the folders an ingestion pipeline wrote to (default whole container)
+    prefixes = [prefix for prefix in req.params.get('prefix', "").split(",") if prefix] or [""]
+    # recursive=false only lists the blobs directly in the prefix folders, not in their subfolders
+    recursive = req.params.get('recursive', "true").lower() == "true"
+    # modified_since=<ISO 8601 timestamp> skips blobs that were not modified since the ingestion started
+    modified_since = parse_timestamp(req.params.get('modified_since'))
 
-    # create blob service client and container client
-    credential = DefaultAzureCredential()
-    storage_account_source_url = "https://" + os.environ["par_storage_account_name_source"] + ".blob.core.windows.net"
-    client_source = BlobServiceClient(account_url=storage_account_source_url, credential=credential)
+    # get blob service client (reused across invocations) and container client
+    client_source = get_source_client()
     container_source = client_source.get_container_client(container_name)
 
-    # Create queue client
-    queue_service = QueueService(account_name=os.environ['par_storage_account_name_queue'], account_key=os.environ['par_storage_account_key_queue'])
-    queue_service.encode_function = QueueMessageFormat.text_base64encode
-
-    # Get all blobs in container
-    prev_blob_name = ""
-    prev_blob_etag = ""
-    blob_list = container_source.list_blobs(include=['snapshots'])
-    for blob in blob_list:
-
-        if blob.snapshot == None:
-            # Blob that is not snapshot
-            if prev_blob_name != blob.name:
-                # New blob without snapshot, create snapshot/backup
-                logging.info("new blob" + blob.name + ", create snapshot/backup")
-                create_snapshot_backup(client_source, queue_service, container_name, blob.name, blob.etag)
-
-            elif prev_blob_etag != blob.etag:
-                # Existing blob that has changed, create snapshot/backup
-                logging.info(blob.name + "has changed, create snapshot/backup")
-                create_snapshot_backup(client_source, queue_service, container_name, blob.name, blob.etag)
-    
-        prev_blob_name = blob.name
-        prev_blob_etag = blob.etag
-
-    result = {"status": "ok"}
-    return func.HttpResponse(str(result))
-
-def create_snapshot_backup(client_source, queue_service, container_name, blob_name, blob_etag):
-
-    # create snapshot
+    # Create queue client, backup requests are batched in messages and sent concurrently
+    backup_queue = BackupRequestQueue(get_queue_client())
+
+    # ETag of the last snapshot per blob is kept in an index per prefix in the state store, snapshots are only
+    # listed once to bootstrap the index of a prefix. Afterwards a blob that is not in the index is new.
+    checkpoint_store = create_checkpoint_store()
+
+    blobs_listed = 0
+    blobs_unchanged = 0
+    snapshot_indexes = []
+    for prefix in prefixes:
+        snapshot_index = load_snapshot_index(checkpoint_store, container_name, prefix, recursive)
+        for blob, latest_snapshot_etag in list_prefix(container_source, prefix, recursive, include_snapshots=not snapshot_index.loaded):
+            blobs_listed += 1
+            if snapshot_index.is_snapshotted(blob.name, blob.etag):
+                blobs_unchanged += 1
+                continue
+            if latest_snapshot_etag is not None and latest_snapshot_etag == blob.etag:
+                # Snapshot was created by the reconciliation or before the index existed
+                snapshot_index.set(blob.name, blob.etag)
+                blobs_unchanged += 1
+                continue
+            if modified_since is not None and blob.last_modified < modified_since:
+                continue
+
+            # New or changed blob, create snapshot/backup
+            logging.info("new or changed blob " + blob.name + ", create snapshot/backup")
+            if create_snapshot_backup(client_source, backup_queue, container_name, blob.name, blob.etag):
+                snapshot_index.set(blob.name, blob.etag)
+        snapshot_indexes.append(snapshot_index)
+
+    # send remaining backup requests
+    backup_queue.close()
+
+    # indexes are saved once all backup requests are sent, a failed send leaves the blobs to the next call
+    for snapshot_index in snapshot_indexes:
+        save_snapshot_index(checkpoint_store, snapshot_index)
+
+    result = {"status": "ok", "blobs_listed": blobs_listed, "blobs_unchanged": blobs_unchanged,
+              "backup_requests": backup_queue.requests_added, "queue_messages": backup_queue.messages_sent, "metrics": invocation.log()}
+    return func.HttpResponse(json.dumps(result), mimetype="application/json")
+
+def list_prefix(container_source, prefix, recursive, include_snapshots=False):
+    # Yields (blob, etag of its latest snapshot or None). Recursive listing is a flat listing of all names starting
+    # with the prefix, otherwise the hierarchical listing returns the blobs of the folder and skips its subfolders.
+    # Snapshots of a blob are listed oldest first before the blob itself and have the etag of the blob at snapshot time.
+    latest_snapshot = None
+    for record in iter_blob_records(container_source, prefix or None, include_snapshots, root_only=not recursive):
+        if record.snapshot is not None:
+            latest_snapshot = record
+            continue
+        yield record, (latest_snapshot.etag if latest_snapshot is not None and latest_snapshot.name == record.name else None)
+        latest_snapshot = None
+
+def create_snapshot_backup(client_source, backup_queue, container_name, blob_name, blob_etag):
+    # Returns False when no snapshot was created because the blob changed after listing
+
+    # create snapshot of the listed version, backup is copied from this snapshot
     blob_client = client_source.get_blob_client(container=container_name, blob=blob_name)
-    blob_client.create_snapshot()
+    try:
+        snapshot = blob_client.create_snapshot(etag=blob_etag, match_condition=MatchConditions.IfNotModified)
+    except (ResourceModifiedError, ResourceNotFoundError):
+        # blob changed or was deleted after listing, next run of the producer handles the new version
+        logging.info("blob " + blob_name + " changed after listing, no snapshot created")
+        return False
 
-    # add message to queue to create backup
-    queue_json = "{" + "\"container\":\"{}\", \"blob_name\":\"{}\", \"etag\":\"{}\"".format(container_name, blob_name, blob_etag) + "}"
-    queue_service.put_message(os.environ['par_queue_name'], queue_json)
\ No newline at end of file
+    # add backup request to queue to create backup
+    backup_queue.add(container_name, blob_name, normalize_etag(blob_etag), snapshot['snapshot'])
+    return True
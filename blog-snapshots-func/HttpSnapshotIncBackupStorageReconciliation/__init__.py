@@ -2,17 +2,40 @@ import logging
 import os
 
 import azure.functions as func
-from azure.identity import DefaultAzureCredential, ClientSecretCredential
-from azure.storage.blob import BlobServiceClient
-from azure.storage.queue import QueueService, QueueMessageFormat
-import requests
 import time
+import json
+import asyncio
+
+from ..shared_code.async_reconcile import reconcile_storage_async
+from ..shared_code.backup_queue import BackupRequestQueue, get_queue_client
+from ..shared_code.checkpoint import create_checkpoint_store, load_container_checkpoint
+from ..shared_code.clients import get_source_client, get_backup_client
+from ..shared_code.metrics import InvocationMetrics, get_metrics
+from ..shared_code.properties_cache import BlobPropertiesCache
+from ..shared_code.reconcile import reconcile_container
+from ..shared_code.sharding import aggregate_sharded_run, start_sharded_run
+
+# Use last_modified/etag from the list_blobs payload instead of get_blob_properties per blob
+USING_LISTING_PROPERTIES = True
+# Reconcile containers and blobs concurrently using the asyncio engine
+USING_ASYNC_ENGINE = False
+# Persist a checkpoint per container and skip blobs that were handled in previous runs
+USING_CHECKPOINT = False
+# Stop listing before the function timeout (default 5 minutes on consumption plan), resume in next run
+DEFAULT_TIME_BUDGET_SECONDS = 240
+RUN_CHECKPOINT_NAME = "_run"
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a request.')
-
-    # DefaultAzureCredential supports managed identity or environment configuration (see docs)
-    credential = DefaultAzureCredential()
+    invocation = InvocationMetrics("HttpSnapshotIncBackupStorageReconciliation")
+    # mode=listing (default) only uses listing properties, mode=properties requests properties per blob
+    using_listing_properties = req.params.get('mode', "listing" if USING_LISTING_PROPERTIES else "properties") == "listing"
+    # engine=async reconciles concurrently, engine=sync (default) one blob at a time,
+    # engine=sharded enqueues partitions for QueueReconcilePartition (add run_id=<id> to get the aggregated result)
+    engine = req.params.get('engine', "async" if USING_ASYNC_ENGINE else "sync")
+    using_async_engine = engine == "async"
+    # incremental=true uses checkpoints of previous runs
+    using_checkpoint = req.params.get('incremental', str(USING_CHECKPOINT)).lower() == "true"
 
     # parse parameters
     storage_account_source = os.environ["par_storage_account_name_source"]
@@ -20,76 +43,77 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     storage_account_backup = os.environ["par_storage_account_name_backup"]
     storage_account_backup_url = "https://" + storage_account_backup + ".blob.core.windows.net"
 
-    # create blob client for backup and source
-    credential = DefaultAzureCredential()
-    client_source = BlobServiceClient(account_url=storage_account_source_url, credential=credential)
-    client_backup = BlobServiceClient(account_url=storage_account_backup_url, credential=credential)
+    # get blob client for backup and source, DefaultAzureCredential supports managed identity or environment configuration (see docs)
+    client_source = get_source_client()
+    client_backup = get_backup_client()
+
+    if engine == "sharded":
+        checkpoint_store = create_checkpoint_store()
+        run_id = req.params.get('run_id')
+        if run_id is None:
+            run_id, partitions = start_sharded_run(client_source, checkpoint_store)
+            result = {"status": "started", "engine": "sharded", "run_id": run_id, "partitions": partitions}
+        else:
+            result = aggregate_sharded_run(checkpoint_store, run_id)
+            if result is None:
+                return func.HttpResponse("unknown run_id " + run_id, status_code=404)
+            result["engine"] = "sharded"
+        result["metrics"] = invocation.log()
+        return func.HttpResponse(json.dumps(result), mimetype="application/json")
+
+    # Create queue client, backup requests are batched in messages and sent concurrently
+    backup_queue = BackupRequestQueue(get_queue_client())
 
-    # Create queue clients
-    queue_service = QueueService(account_name=os.environ['par_storage_account_name_queue'], account_key=os.environ['par_storage_account_key_queue'])
-    queue_service.encode_function = QueueMessageFormat.text_base64encode
+    if using_async_engine:
+        # async engine always works from listing properties
+        async_result = asyncio.run(reconcile_storage_async(storage_account_source_url, storage_account_backup_url, backup_queue))
+        backup_queue.close()
+        result = {"status": "ok", "engine": "async", "queue_messages": backup_queue.messages_sent}
+        result.update(async_result.to_dict())
+        result["metrics"] = invocation.log()
+        return func.HttpResponse(json.dumps(result), mimetype="application/json")
+
+    # Per-run properties cache, primed by listing
+    properties_cache = BlobPropertiesCache()
+
+    # Incremental runs skip blobs handled in a previous run and resume listings that were interrupted
+    checkpoint_store = create_checkpoint_store() if using_checkpoint else None
+    run_state = (checkpoint_store.load(RUN_CHECKPOINT_NAME) if using_checkpoint else None) or {}
+    resume_container = run_state.get("resume_container")
+    deadline = time.time() + int(req.params.get('time_budget', os.environ.get("par_reconcile_time_budget_seconds", DEFAULT_TIME_BUDGET_SECONDS)))
 
     # Get all blobs in sourcecontainer
+    status = "ok"
     container_source_list = client_source.list_containers()
     for container in container_source_list:
+        # Containers are listed in lexicographic order, skip the ones completed before the previous run was interrupted
+        if resume_container is not None and container.name < resume_container:
+            continue
         # Log container name
         logging.info(container.name)
-        container_source = client_source.get_container_client(container.name)
-        
-        # Get all blobs in container
-        prev_blob_name = ""
-        prev_blob_etag = ""        
-        blob_source_list = container_source.list_blobs(include=['snapshots'])
-        for blob in blob_source_list:
-
-            if blob.snapshot == None:
-                # Blob that is not snapshot.
-                # 1. Check if snapshot needs to be created
-                if prev_blob_name != blob.name:
-                    # New blob without snapshot, create snapshot/backup
-                    logging.info("new blob" + blob.name + ", create snapshot/backup")
-                    create_snapshot(client_source, queue_service, container.name, blob.name, blob.etag)
-                elif prev_blob_etag != blob.etag:
-                    # Existing blob that has changed, create snapshot/backup
-                    logging.info(blob.name + "has changed, create snapshot/backup")
-                    create_snapshot(client_source, queue_service, container.name, blob.name, blob.etag)
-    
-                # 2. Check if incremental backup needs to be created
-                # get blob backup and source properties
-                blob_source = client_source.get_blob_client(container=container.name, blob=blob.name)
-                source_last_modified = blob_source.get_blob_properties()['last_modified']
-                source_etag = str(blob_source.get_blob_properties()['etag']).replace("\"","")
-                blob_name_backup = append_timestamp_etag(blob.name, source_last_modified, source_etag)
-                blob_backup = client_backup.get_blob_client(container=container.name + "bak", blob=blob_name_backup)
-                blob_exists = check_blob_exists(blob_backup)
-                # Check if blob exists
-                if blob_exists == False:
-                    # Latest blob does not yet exist in backup, create message on queue to update
-                    queue_json = "{" + "\"container\":\"{}\", \"blob_name\":\"{}\", \"etag\":\"{}\"".format(container.name, blob.name, source_etag) + "}"
-                    logging.info("backup needed for: " + queue_json)
-                    queue_service.put_message(os.environ['par_queue_name'], queue_json)                
-                    #asyncio.run(copy_adf_blob_source_backup(blob_source, blob_backup))
-            
-            prev_blob_name = blob.name
-            prev_blob_etag = blob.etag
-
-    result = {"status": "ok"}
-    return func.HttpResponse(str(result))
+        checkpoint = load_container_checkpoint(checkpoint_store, container.name) if using_checkpoint else None
+        with get_metrics().timer("reconcile.container"):
+            completed = reconcile_container(client_source, client_backup, backup_queue, container.name, properties_cache, using_listing_properties, checkpoint, checkpoint_store, deadline)
+        if not completed:
+            # Out of time, next run resumes at this container
+            status = "partial"
+            checkpoint_store.save(RUN_CHECKPOINT_NAME, json.dumps({"resume_container": container.name}))
+            break
 
-def check_blob_exists(bc_blob):
-    # Check if blob already exists
-    # todo: see if this can be done without try except
-    try:
-        bc_blob.get_blob_properties()
-        return True
-    except:
-        return False
+    # send remaining backup requests
+    backup_queue.close()
 
-def create_snapshot(client_source, queue_service, container_name, blob_name, blob_etag):
-    # create snapshot
-    blob_client = client_source.get_blob_client(container=container_name, blob=blob_name)
-    blob_client.create_snapshot()
+    if using_checkpoint and status == "ok":
+        checkpoint_store.save(RUN_CHECKPOINT_NAME, json.dumps({"resume_container": None}))
 
-def append_timestamp_etag(filename, source_modified, etag):
-    name, ext = os.path.splitext(filename)
-    return "{name}_{modified}_{etag}{ext}".format(name=name, modified=source_modified, etag=etag, ext=ext)
\ No newline at end of file
+    result = {
+        "status": status,
+        "mode": "listing" if using_listing_properties else "properties",
+        "incremental": using_checkpoint,
+        "backup_requests": backup_queue.requests_added,
+        "queue_messages": backup_queue.messages_sent,
+        "source_property_calls_issued": properties_cache.calls_issued,
+        "source_property_calls_saved": properties_cache.calls_saved
+    }
+    result["metrics"] = invocation.log()
+    return func.HttpResponse(json.dumps(result), mimetype="application/json")
@@ -2,157 +2,297 @@ import logging
 import os, json
 import azure.functions as func
 
-from azure.storage.blob import BlobServiceClient
-from azure.identity import DefaultAzureCredential, ClientSecretCredential
-import requests
-import time
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
-USING_BLOB_LEASE = True
-MAX_LEASE_COPY_TIME_MINUTES = 10
+from ..shared_code.adf_client import create_pipeline_run
+from ..shared_code.backup_messages import decode_message
+from ..shared_code.backup_naming import append_timestamp_etag
+from ..shared_code.clients import get_source_client, get_backup_client
+from ..shared_code.copy_tracker import register_copy
+from ..shared_code.delta_backup import backup_blob_delta, use_delta_backup
+from ..shared_code.dedup import find_backup_with_content, get_content_hash, register_backup_content, write_backup_reference
+from ..shared_code.metrics import bind_context, InvocationMetrics, get_metrics
+from ..shared_code.direct_copy import copy_blob_direct, get_source_url, use_direct_copy, ADF_SAS_VALIDITY_HOURS
+
+# Copy blobs up to par_direct_copy_max_bytes with server-side copy, larger blobs are copied using ADFv2
+USING_DIRECT_COPY = True
+# Number of backup requests of a batched message that are copied at the same time
+DEFAULT_MAX_CONCURRENT_COPIES = 16
+# Copy many blobs in one ADFv2 pipeline run (pipeline par_adfv2_batch_pipeline_name) instead of one run per blob
+USING_ADF_BATCH = False
+DEFAULT_ADF_BATCH_MAX_BLOBS = 100
+DEFAULT_ADF_BATCH_MAX_BYTES = 10 * 1024 * 1024 * 1024
+# Versions with content already in backup are stored as reference to the existing backup instead of copied again.
+# Off by default, every copy costs two HEAD requests and a marker PUT extra.
+USING_DEDUP = False
+# Blobs from par_delta_min_bytes are backed up as changed chunks plus manifest instead of a full copy
+USING_DELTA_BACKUP = False
+
+# Backup containers known to exist, kept across invocations in the same worker process
+_backup_containers_lock = threading.Lock()
+_backup_containers = set()
 
 def main(msg: func.QueueMessage) -> None:
     logging.info('Python queue trigger function processed a queue item: %s',
                  msg.get_body().decode('utf-8'))
 
-    # get raw parameters
+    # get raw parameters, message contains one or more backup requests
     raw = msg.get_body().decode('utf-8')
     logging.info(raw)
-    msg_json =json.loads(raw)
-
-    # parse parameters
-    storage_account_source = os.environ["par_storage_account_name_source"]
-    storage_account_source_url = "https://" + storage_account_source + ".blob.core.windows.net"
-    storage_account_backup = os.environ["par_storage_account_name_backup"]
-    storage_account_backup_url = "https://" + storage_account_backup + ".blob.core.windows.net"
-    container_source = msg_json['container']
-    container_backup = msg_json['container'] + "bak"
-    blob_name = msg_json["blob_name"]
-    blob_etag = msg_json["etag"]
-
-    # create blob client for backup and source
-    credential = DefaultAzureCredential()
-    client_backup = BlobServiceClient(account_url=storage_account_backup_url, credential=credential)
-    blob_backup = client_backup.get_blob_client(container=container_backup, blob=blob_name)
-    client_source = BlobServiceClient(account_url=storage_account_source_url, credential=credential)
-    blob_source = client_source.get_blob_client(container=container_source, blob=blob_name)
-    create_container_backup_if_not_exists(client_backup, container_backup)
-
-    # check if source blob is not changed
-    if source_blob_changed(blob_source, blob_name, container_source, blob_etag) == True:
+    backup_requests = decode_message(raw)
+
+    # Queue lag is the time between enqueue by the producer or reconciliation and the start of the copies
+    invocation = InvocationMetrics("QueueCreateBlobBackupADFv2")
+    if msg.insertion_time is not None:
+        insertion_time = msg.insertion_time if msg.insertion_time.tzinfo is not None else msg.insertion_time.replace(tzinfo=timezone.utc)
+        get_metrics().observe("queue.lag", (datetime.now(timezone.utc) - insertion_time).total_seconds())
+    get_metrics().count("backup.requests", len(backup_requests))
+
+    try:
+        backup_blobs(backup_requests)
+    finally:
+        invocation.log()
+
+def backup_blobs(backup_requests):
+    # get blob client for backup and source, reused across invocations
+    client_backup = get_backup_client()
+    client_source = get_source_client()
+    for container_backup in set(backup_request.container + "bak" for backup_request in backup_requests):
+        create_container_backup_if_not_exists(client_backup, container_backup)
+
+    if USING_ADF_BATCH:
+        backup_blobs_batched(client_source, client_backup, backup_requests)
+        return
+
+    # Fan out batched message in concurrent copies
+    max_workers = min(len(backup_requests), int(os.environ.get("par_max_concurrent_copies", DEFAULT_MAX_CONCURRENT_COPIES)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(bind_context(backup_blob), client_source, client_backup, backup_request) for backup_request in backup_requests]
+    for backup_request, future in zip(backup_requests, futures):
+        if future.exception() is not None:
+            get_metrics().count("backup.failed")
+            logging.info("backup of blob " + backup_request.blob_name + " in container " + backup_request.container + " failed: " + str(future.exception()))
+
+def backup_blob(client_source, client_backup, backup_request):
+    container_source = backup_request.container
+    blob_name = backup_request.blob_name
+    blob_etag = backup_request.etag
+
+    # Backup is copied from the snapshot of the requested version, the source blob itself is not locked
+    blob_snapshot_properties = get_snapshot_properties(client_source, backup_request)
+    if blob_snapshot_properties is None:
+        return
+    blob_name_backup = append_timestamp_etag(blob_name, blob_snapshot_properties.last_modified, blob_etag)
+
+    content_hash, referenced = deduplicate_backup(client_source, client_backup, backup_request, blob_snapshot_properties, blob_name_backup)
+    if referenced:
+        get_metrics().count("backup.deduplicated")
+        return
+
+    if USING_DELTA_BACKUP and use_delta_backup(blob_snapshot_properties.size):
+        # Only chunks changed since the previous backup of the blob are uploaded
+        with get_metrics().timer("copy.delta"):
+            bytes_uploaded = backup_blob_delta(client_source, client_backup, container_source, blob_name, blob_name_backup, blob_snapshot_properties.size, backup_request.snapshot)
+        get_metrics().count("copy.delta_bytes_uploaded", bytes_uploaded)
+        if content_hash is not None:
+            register_backup_content(client_backup, container_source + "bak", content_hash, blob_name_backup)
+        return
+
+    if USING_DIRECT_COPY and use_direct_copy(blob_snapshot_properties.size):
+        # Small and medium blobs are copied by the storage service directly
+        with get_metrics().timer("copy.direct"):
+            copy_blob_direct(client_source, client_backup, container_source, blob_name, blob_name_backup, blob_snapshot_properties.size, backup_request.snapshot)
+        get_metrics().count("copy.direct_bytes", blob_snapshot_properties.size)
+        if content_hash is not None:
+            register_backup_content(client_backup, container_source + "bak", content_hash, blob_name_backup)
         return
 
     # Start copying using ADFv2
     try:
-        if not USING_BLOB_LEASE:
-            copy_adf_blob_source_backup(blob_source, client_backup, blob_backup, blob_etag)
-        else:
-            # Copy with blob lease locks the file
-            copy_with_lease(blob_source, client_backup, blob_backup, blob_etag)
+        with get_metrics().timer("copy.adf_start"):
+            run_id = copy_adf_blob_source_backup(client_source, backup_request, blob_name_backup)
     except:
         logging.info("copy failed")
+        return
+    if run_id is None:
+        return
+    # outcome of the run is checked by TimerTrackBackupCopies
+    register_copy(container_source, run_id, [blob_name_backup])
+    if content_hash is not None:
+        register_backup_content(client_backup, container_source + "bak", content_hash, blob_name_backup)
 
-def copy_with_lease(blob_source, client_backup, blob_backup, blob_etag):
+def deduplicate_backup(client_source, client_backup, backup_request, blob_snapshot_properties, blob_name_backup):
+    # Returns (content_hash, referenced). When the content is already in backup, a reference is written instead of a copy.
+    if not USING_DEDUP:
+        return None, False
+    container_backup = backup_request.container + "bak"
+    blob_snapshot = client_source.get_blob_client(container=backup_request.container, blob=backup_request.blob_name, snapshot=backup_request.snapshot)
+    content_hash = get_content_hash(blob_snapshot, blob_snapshot_properties)
+    if content_hash is None:
+        return None, False
+    blob_name_target = find_backup_with_content(client_backup, container_backup, content_hash)
+    if blob_name_target is None:
+        return content_hash, False
+    if blob_name_target != blob_name_backup:
+        # backup of this exact version is the target itself when the request was sent twice, nothing to write then
+        write_backup_reference(client_backup, container_backup, blob_name_backup, content_hash, blob_name_target)
+    return content_hash, True
 
-    # Try to acquire lease on blob
-    try:
-        blob_lease_source = blob_source.acquire_lease(lease_duration=30) # seconds
-    except:
-        logging.info("lease failed")
-        return
+def backup_blobs_batched(client_source, client_backup, backup_requests):
+    # Resolve snapshots concurrently, blobs are copied in as few pipeline runs as possible
+    max_workers = min(len(backup_requests), int(os.environ.get("par_max_concurrent_copies", DEFAULT_MAX_CONCURRENT_COPIES)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        snapshot_properties = list(executor.map(bind_context(lambda backup_request: get_snapshot_properties(client_source, backup_request)), backup_requests))
 
-    # Start copy using ADFv2
-    start_copy = copy_adf_blob_source_backup(blob_source, client_backup, blob_backup, blob_etag)
-    if not start_copy:
-        blob_lease_source.release()
-        return
-    # Wait until copy is finished
-    retry = 0
-    logging.info("0 seconds passed, blob {} being copied to {}".format(blob_backup.container_name, blob_backup.blob_name))
-    while retry < MAX_LEASE_COPY_TIME_MINUTES * 4:
-        time.sleep(15) # wait 15 seconds before next status update
-        blob_copy_finished = check_blob_copy_finished(client_backup, blob_backup.container_name, blob_backup.blob_name)
-        if not blob_copy_finished:
-            # File is not copied yet
-            logging.info("{} seconds passed, blob {} being copied to {}".format(str(retry*15), blob_backup.container_name, blob_backup.blob_name))
-            # extend lease
-            blob_lease_source = blob_source.acquire_lease(lease_duration=30, lease_id=blob_lease_source.id)
-        else:
-            break
-        retry += 1
-
-    # Finally, release lease
-    blob_lease_source.release()
-
-def copy_adf_blob_source_backup(blob_source, client_backup, blob_backup, etag):
-
-    source_modified = blob_source.get_blob_properties()['last_modified']
-    blob_name_backup = append_timestamp_etag(blob_source.blob_name, source_modified, etag)
-    # create bearer token to authenticate to adfv2
-    msi_endpoint = os.environ["MSI_ENDPOINT"]
-    msi_secret = os.environ["MSI_SECRET"]
-    
-    token_auth_uri = f"{msi_endpoint}?resource=https%3A%2F%2Fmanagement.azure.com%2F&api-version=2017-09-01"
-    head_msi = {'Secret':msi_secret}
-    resp = requests.get(token_auth_uri, headers=head_msi)
-    access_token = resp.json()['access_token']
-
-    url = "https://management.azure.com/subscriptions/{}/resourceGroups/{}/providers/Microsoft.DataFactory/factories/{}/pipelines/{}/createRun?api-version=2018-06-01".format(os.environ["par_subscription_id"], os.environ["par_resource_group_name"], os.environ["par_adfv2_name"], os.environ["par_adfv2_pipeline_name"])
-    response = requests.post(url, 
-        headers={'Authorization': "Bearer " + access_token},
-        json={
-            "container": "{}".format(blob_source.container_name),
-            "container_backup": "{}".format(blob_backup.container_name),
-            "blob_name": "{}".format(blob_source.blob_name),
-            "blob_name_backup": "{}".format(blob_name_backup)
-        }
-    )
+    pending = [(backup_request, properties) for backup_request, properties in zip(backup_requests, snapshot_properties) if properties is not None]
+
+    # Versions with content already in backup are not copied
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        deduplicated = list(executor.map(bind_context(lambda item: deduplicate_backup(client_source, client_backup, item[0], item[1],
+                                                                                      append_timestamp_etag(item[0].blob_name, item[1].last_modified, item[0].etag))), pending))
+    pending = [(backup_request, properties, content_hash) for (backup_request, properties), (content_hash, referenced) in zip(pending, deduplicated) if not referenced]
+
+    # Large blobs in delta mode are backed up chunk by chunk, one blob at a time since chunks are uploaded concurrently
+    if USING_DELTA_BACKUP:
+        for backup_request, properties, content_hash in [item for item in pending if use_delta_backup(item[1].size)]:
+            blob_name_backup = append_timestamp_etag(backup_request.blob_name, properties.last_modified, backup_request.etag)
+            try:
+                backup_blob_delta(client_source, client_backup, backup_request.container, backup_request.blob_name, blob_name_backup, properties.size, backup_request.snapshot)
+            except Exception as e:
+                logging.info("delta backup of blob " + backup_request.blob_name + " failed: " + str(e))
+                continue
+            if content_hash is not None:
+                register_backup_content(client_backup, backup_request.container + "bak", content_hash, blob_name_backup)
+        pending = [item for item in pending if not use_delta_backup(item[1].size)]
+
+    # Small and medium blobs are copied directly, only large blobs are copied in pipeline runs
+    if USING_DIRECT_COPY:
+        direct = [item for item in pending if use_direct_copy(item[1].size)]
+        pending = [item for item in pending if not use_direct_copy(item[1].size)]
+        if direct:
+            with ThreadPoolExecutor(max_workers=min(len(direct), max_workers)) as executor:
+                futures = [executor.submit(bind_context(copy_blob_direct), client_source, client_backup, backup_request.container, backup_request.blob_name,
+                                           append_timestamp_etag(backup_request.blob_name, properties.last_modified, backup_request.etag),
+                                           properties.size, backup_request.snapshot) for backup_request, properties, _ in direct]
+            for (backup_request, properties, content_hash), future in zip(direct, futures):
+                if future.exception() is not None:
+                    logging.info("copy of blob " + backup_request.blob_name + " failed: " + str(future.exception()))
+                elif content_hash is not None:
+                    register_backup_content(client_backup, backup_request.container + "bak", content_hash,
+                                            append_timestamp_etag(backup_request.blob_name, properties.last_modified, backup_request.etag))
+
+    for container_source, batch in group_backup_batches(pending):
+        manifest = [{
+            "blob_name": backup_request.blob_name,
+            "blob_name_backup": append_timestamp_etag(backup_request.blob_name, properties['last_modified'], backup_request.etag),
+            "source_url": get_source_url(client_source, container_source, backup_request.blob_name, backup_request.snapshot, ADF_SAS_VALIDITY_HOURS)
+        } for backup_request, properties, _ in batch]
+        try:
+            with get_metrics().timer("copy.adf_batch_start"):
+                run_id = copy_adf_batch(container_source, manifest)
+        except:
+            logging.info("copy of batch of {} blobs in container {} failed".format(len(manifest), container_source))
+            continue
+        if run_id is None:
+            continue
+        register_copy(container_source, run_id, [entry["blob_name_backup"] for entry in manifest])
+        for (_, _, content_hash), entry in zip(batch, manifest):
+            if content_hash is not None:
+                register_backup_content(client_backup, container_source + "bak", content_hash, entry["blob_name_backup"])
+
+def group_backup_batches(pending):
+    # Group (backup_request, properties, content_hash) items per container, a batch is closed when it reaches the blob count or byte threshold
+    max_blobs = int(os.environ.get("par_adf_batch_max_blobs", DEFAULT_ADF_BATCH_MAX_BLOBS))
+    max_bytes = int(os.environ.get("par_adf_batch_max_bytes", DEFAULT_ADF_BATCH_MAX_BYTES))
+    per_container = {}
+    for item in pending:
+        per_container.setdefault(item[0].container, []).append(item)
+
+    for container_source, container_pending in per_container.items():
+        batch = []
+        batch_bytes = 0
+        for item in container_pending:
+            size = item[1]['size']
+            if batch and (len(batch) >= max_blobs or batch_bytes + size > max_bytes):
+                yield container_source, batch
+                batch = []
+                batch_bytes = 0
+            batch.append(item)
+            batch_bytes += size
+        if batch:
+            yield container_source, batch
+
+def copy_adf_batch(container_source, manifest):
+    # One pipeline run copies all blobs of the manifest using a ForEach activity, returns run id or None
+    response = create_pipeline_run(os.environ["par_adfv2_batch_pipeline_name"], {
+        "container": container_source,
+        "container_backup": container_source + "bak",
+        # manifest holds SAS urls, it is passed as SecureString so it is masked in the run history
+        "manifest": json.dumps(manifest)
+    })
+
+    # Check if copy is correctly started
+    if response.status_code != 200:
+        logging.info("Error: " + str(response.content))
+        return None
+    logging.info("{} blobs of container {} being copied to {}bak".format(len(manifest), container_source, container_source))
+    return response.json()["runId"]
+
+def copy_adf_blob_source_backup(client_source, backup_request, blob_name_backup):
+    # Starts pipeline run copying the snapshot to backup, returns run id or None
+    # ADFv2 reads the immutable snapshot using a SAS url (SecureString parameter), queue wait plus copy must finish within ADF_SAS_VALIDITY_HOURS
+    response = create_pipeline_run(os.environ["par_adfv2_pipeline_name"], {
+        "container": "{}".format(backup_request.container),
+        "container_backup": "{}".format(backup_request.container + "bak"),
+        "blob_name": "{}".format(backup_request.blob_name),
+        "blob_name_backup": "{}".format(blob_name_backup),
+        "source_url": get_source_url(client_source, backup_request.container, backup_request.blob_name, backup_request.snapshot, ADF_SAS_VALIDITY_HOURS)
+    })
 
     # Check if copy is correctly started
     if response.status_code != 200:
         logging.info("Error: " + str(response.content))
-        return True
+        return None
     else:
-        logging.info("blob {} being copied to {}".format(blob_backup.container_name, blob_backup.blob_name))
-        return False
+        logging.info("blob {} being copied to {}bak/{}".format(backup_request.blob_name, backup_request.container, blob_name_backup))
+        return response.json()["runId"]
 
-def source_blob_changed(blob_source, blob_name, container_source, blob_etag):
-    # Get properties of blob on source. In case of exception, blob does not exist anymore. Edge case.
-    try:
-        blob_source_properties = blob_source.get_blob_properties()
-    except:
-        logging.info("blob " + blob_name + " in container " +  container_source + " does not exist anymore")
-        return True
-
-    # Check if etag of blob is not changed
-    int_blob_source_etag = int(blob_source_properties.etag.replace("\"",""),16)
-    int_par_etag = int(blob_etag.replace("\"",""),16)
-    if int_blob_source_etag != int_par_etag:
-        logging.info("blob has already changed, old: " + str(blob_etag) + ", new: " + str(blob_source.get_blob_properties().etag))
-        # New etag has created new backup request, therefore quit this backup request
-        return True
-
-    return False
-
-def check_blob_copy_finished(client, container_name, blob_name):
-    # Check if blob already exists
-    # todo: see if this can be done without try except
-    logging.info
-    try:
-        blob_source = client.get_blob_client(container=container_name, blob=blob_name)
-        blob_source.get_blob_properties()
-        return True
-    except:
-        return False
+def get_snapshot_properties(client_source, backup_request):
+    # Returns properties of the snapshot to back up, or None when there is nothing to back up anymore.
+    # Requests without snapshot (sent by earlier versions) get a snapshot now, as long as the blob was not changed.
+    blob_name = backup_request.blob_name
+    container_source = backup_request.container
+    if backup_request.snapshot is None:
+        blob_source = client_source.get_blob_client(container=container_source, blob=blob_name)
+        try:
+            backup_request.snapshot = blob_source.create_snapshot(etag="\"" + backup_request.etag + "\"", match_condition=MatchConditions.IfNotModified)['snapshot']
+        except ResourceNotFoundError:
+            logging.info("blob " + blob_name + " in container " +  container_source + " does not exist anymore")
+            return None
+        except ResourceModifiedError:
+            # New etag has created new backup request, therefore quit this backup request
+            logging.info("blob has already changed, old: " + str(backup_request.etag))
+            return None
 
-def append_timestamp_etag(filename, source_modified, etag):
-    name, ext = os.path.splitext(filename)
-    return "{name}_{modified}_{etag}{ext}".format(name=name, modified=source_modified, etag=etag, ext=ext)
+    # Get properties of snapshot. In case of exception, snapshot was deleted. Edge case.
+    try:
+        return client_source.get_blob_client(container=container_source, blob=blob_name, snapshot=backup_request.snapshot).get_blob_properties()
+    except ResourceNotFoundError:
+        logging.info("snapshot " + backup_request.snapshot + " of blob " + blob_name + " in container " +  container_source + " does not exist anymore")
+        return None
 
 def create_container_backup_if_not_exists(client, container_name):
-    # blob does not exists, test if container exists and if not, create
-    # todo: see if this can be done without try except
-    container_client = client.get_container_client(container_name)
+    # test if container exists and if not, create. Containers created or found before are not checked again.
+    with _backup_containers_lock:
+        if container_name in _backup_containers:
+            return
     try:
-        container_client.get_container_properties()
-    except:
-        client.create_container(container_name)
\ No newline at end of file
+        client.create_container(container_name)
+    except ResourceExistsError:
+        pass
+    with _backup_containers_lock:
+        _backup_containers.add(container_name)
@@ -0,0 +1,20 @@
+import logging
+import json
+
+import azure.functions as func
+
+from ..shared_code.checkpoint import create_checkpoint_store
+from ..shared_code.clients import get_source_client, get_backup_client
+from ..shared_code.metrics import InvocationMetrics
+from ..shared_code.sharding import reconcile_partition
+
+def main(msg: func.QueueMessage) -> None:
+    logging.info('Python queue trigger function processed a queue item: %s',
+                 msg.get_body().decode('utf-8'))
+
+    invocation = InvocationMetrics("QueueReconcilePartition")
+    # Message contains the run id, the container and the prefix of the partition, see shared_code/sharding.py
+    partition = json.loads(msg.get_body().decode('utf-8'))
+    result = reconcile_partition(get_source_client(), get_backup_client(), create_checkpoint_store(), partition, msg.dequeue_count)
+    logging.info(json.dumps(result))
+    invocation.log()
@@ -0,0 +1,19 @@
+import logging
+import os
+import json
+
+import azure.functions as func
+
+from ..shared_code.clients import get_source_client, get_backup_client
+from ..shared_code.metrics import InvocationMetrics
+from ..shared_code.retention import apply_retention
+
+def main(timer: func.TimerRequest) -> None:
+    logging.info('Python timer trigger function applies retention to snapshots and backups.')
+
+    invocation = InvocationMetrics("TimerBackupRetention")
+    # Expired snapshots and backup versions are deleted in Blob Batch requests, see par_retention_* settings
+    prune_backup_containers = os.environ.get("par_retention_prune_backups", "true").lower() == "true"
+    result = apply_retention(get_source_client(), get_backup_client(), prune_backup_containers)
+    logging.info(json.dumps(result))
+    invocation.log()
@@ -0,0 +1,16 @@
+import logging
+import json
+
+import azure.functions as func
+
+from ..shared_code.copy_tracker import track_copies
+from ..shared_code.metrics import InvocationMetrics
+
+def main(timer: func.TimerRequest) -> None:
+    logging.info('Python timer trigger function tracks the outcome of ADFv2 backup copies.')
+
+    invocation = InvocationMetrics("TimerTrackBackupCopies")
+    # Status of all started pipeline runs is queried in batches, finished runs are counted and their records deleted
+    result = track_copies()
+    logging.info(json.dumps(result))
+    invocation.log()
@@ -0,0 +1,88 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .metrics import get_metrics
+
+MANAGEMENT_RESOURCE = "https://management.azure.com/"
+# Tokens are refreshed this many seconds before they expire
+TOKEN_REFRESH_MARGIN_SECONDS = 300
+HTTP_POOL_SIZE = 32
+# Lifetime assumed for a token whose expires_on cannot be parsed
+FALLBACK_TOKEN_TTL_SECONDS = 600
+
+# Module level state is kept across invocations in the same worker process
+_token_lock = threading.Lock()
+_token_cache = {}
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE))
+
+def parse_expires_on(expires_on):
+    # api-version 2017-09-01 returns a date ("09/14/2017 12:00:00 PM +00:00"), later versions epoch seconds.
+    # The date format depends on the culture of the host, unknown formats get a short fixed lifetime.
+    try:
+        return float(expires_on)
+    except (TypeError, ValueError):
+        pass
+    for date_format in ("%m/%d/%Y %I:%M:%S %p %z", "%m/%d/%Y %H:%M:%S %z"):
+        try:
+            return datetime.strptime(expires_on, date_format).timestamp()
+        except (TypeError, ValueError):
+            continue
+    logging.info("unknown token expires_on format " + str(expires_on) + ", token is refreshed after " + str(FALLBACK_TOKEN_TTL_SECONDS) + " seconds")
+    return time.time() + FALLBACK_TOKEN_TTL_SECONDS
+
+def get_msi_token(resource=MANAGEMENT_RESOURCE):
+    # Token of the function Managed Identity, cached per resource until shortly before it expires
+    with _token_lock:
+        cached = _token_cache.get(resource)
+        if cached is not None and cached[1] - time.time() > TOKEN_REFRESH_MARGIN_SECONDS:
+            get_metrics().count("adf.token_cache_hits")
+            return cached[0]
+
+        msi_endpoint = os.environ["MSI_ENDPOINT"]
+        msi_secret = os.environ["MSI_SECRET"]
+        get_metrics().count("adf.token_fetches")
+        with get_metrics().timer("adf.token_fetch"):
+            response = _session.get(msi_endpoint, params={"resource": resource, "api-version": "2017-09-01"}, headers={'Secret': msi_secret})
+        response.raise_for_status()
+        token = response.json()
+        _token_cache[resource] = (token['access_token'], parse_expires_on(token['expires_on']))
+        logging.info("new token for resource " + resource + ", expires on " + str(token['expires_on']))
+        return token['access_token']
+
+def get_factory_url():
+    return "https://management.azure.com/subscriptions/{}/resourceGroups/{}/providers/Microsoft.DataFactory/factories/{}".format(os.environ["par_subscription_id"], os.environ["par_resource_group_name"], os.environ["par_adfv2_name"])
+
+def create_pipeline_run(pipeline_name, parameters):
+    url = get_factory_url() + "/pipelines/{}/createRun?api-version=2018-06-01".format(pipeline_name)
+    token = get_msi_token()
+    get_metrics().count("adf.create_run")
+    with get_metrics().timer("adf.create_run"):
+        return _session.post(url, headers={'Authorization': "Bearer " + token}, json=parameters)
+
+def query_pipeline_runs(run_ids, updated_after):
+    # Runs with the given ids updated after updated_after, one queryPipelineRuns request per page of results
+    url = get_factory_url() + "/queryPipelineRuns?api-version=2018-06-01"
+    body = {
+        "lastUpdatedAfter": updated_after.isoformat(),
+        "lastUpdatedBefore": (datetime.now(timezone.utc) + timedelta(minutes=5)).isoformat(),
+        "filters": [{"operand": "RunId", "operator": "In", "values": list(run_ids)}]
+    }
+    runs = []
+    while True:
+        token = get_msi_token()
+        get_metrics().count("adf.query_runs")
+        with get_metrics().timer("adf.query_runs"):
+            response = _session.post(url, headers={'Authorization': "Bearer " + token}, json=body)
+        response.raise_for_status()
+        result = response.json()
+        runs.extend(result.get("value", []))
+        if not result.get("continuationToken"):
+            return runs
+        body["continuationToken"] = result["continuationToken"]
@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import os
+
+import aiohttp
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceModifiedError, ResourceNotFoundError
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.identity.aio import DefaultAzureCredential
+from azure.storage.blob.aio import BlobServiceClient
+
+from .backup_index import BackupIndex, LIST_BLOBS_PAGE_SIZE
+from .backup_naming import normalize_etag
+from .metrics import STORAGE_METRICS_HOOKS
+from .throttling import ThrottleStats, retry_on_throttle_async
+
+# Default concurrency limits, can be overridden with app settings
+DEFAULT_MAX_CONCURRENT_CONTAINERS = 4
+DEFAULT_MAX_CONCURRENCY_SOURCE = 32
+DEFAULT_MAX_CONCURRENCY_BACKUP = 16
+
+def get_concurrency_setting(name, default):
+    return int(os.environ.get(name, default))
+
+class ReconcileLimits:
+    # One semaphore per storage account, shared by all containers reconciled in this run
+
+    def __init__(self):
+        self.containers = asyncio.Semaphore(get_concurrency_setting("par_max_concurrent_containers", DEFAULT_MAX_CONCURRENT_CONTAINERS))
+        self.source = asyncio.Semaphore(get_concurrency_setting("par_max_concurrency_source", DEFAULT_MAX_CONCURRENCY_SOURCE))
+        self.backup = asyncio.Semaphore(get_concurrency_setting("par_max_concurrency_backup", DEFAULT_MAX_CONCURRENCY_BACKUP))
+
+class ReconcileResult:
+    def __init__(self):
+        self.containers = 0
+        self.blobs = 0
+        self.snapshots_created = 0
+        self.backups_requested = 0
+        self.throttle = ThrottleStats()
+
+    def to_dict(self):
+        return {
+            "containers": self.containers,
+            "blobs": self.blobs,
+            "snapshots_created": self.snapshots_created,
+            "backups_requested": self.backups_requested,
+            "throttle_retries": self.throttle.retries
+        }
+
+async def reconcile_storage_async(storage_account_source_url, storage_account_backup_url, backup_queue):
+    # Source and backup clients share one aiohttp connection pool, the pool size follows the configured concurrency limits
+    pool_size = get_concurrency_setting("par_max_concurrency_source", DEFAULT_MAX_CONCURRENCY_SOURCE) + get_concurrency_setting("par_max_concurrency_backup", DEFAULT_MAX_CONCURRENCY_BACKUP)
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=pool_size)) as session:
+        async with DefaultAzureCredential() as credential:
+            client_source = BlobServiceClient(account_url=storage_account_source_url, credential=credential, transport=AioHttpTransport(session=session, session_owner=False), **STORAGE_METRICS_HOOKS)
+            client_backup = BlobServiceClient(account_url=storage_account_backup_url, credential=credential, transport=AioHttpTransport(session=session, session_owner=False), **STORAGE_METRICS_HOOKS)
+            async with client_source, client_backup:
+                return await reconcile_accounts_async(client_source, client_backup, backup_queue)
+
+async def reconcile_accounts_async(client_source, client_backup, backup_queue):
+    # Reconcile all containers of the source account concurrently. Backup requests are added to backup_queue,
+    # which batches them and sends full messages on its own worker threads.
+    limits = ReconcileLimits()
+    result = ReconcileResult()
+    tasks = []
+    async for container in client_source.list_containers():
+        tasks.append(asyncio.ensure_future(reconcile_container_async(client_source, client_backup, backup_queue, container.name, limits, result)))
+    await asyncio.gather(*tasks)
+    return result
+
+async def build_backup_index_async(client_backup, container_name_backup, limits):
+    index = BackupIndex(container_name_backup)
+    container_backup = client_backup.get_container_client(container_name_backup)
+    try:
+        async with limits.backup:
+            async for page in container_backup.list_blobs(results_per_page=LIST_BLOBS_PAGE_SIZE).by_page():
+                index.pages_listed += 1
+                async for blob in page:
+                    index.add(blob.name)
+    except ResourceNotFoundError:
+        logging.info("backup container " + container_name_backup + " does not exist yet")
+    return index
+
+async def reconcile_container_async(client_source, client_backup, backup_queue, container_name, limits, result):
+    async with limits.containers:
+        logging.info(container_name)
+        result.containers += 1
+        container_source = client_source.get_container_client(container_name)
+        backup_index = await build_backup_index_async(client_backup, container_name + "bak", limits)
+
+        # Decisions depend on listing order (snapshots are listed before their base blob) and are made
+        # sequentially, the resulting snapshot and queue operations run concurrently.
+        pending = []
+        prev_blob_name = ""
+        prev_blob_etag = ""
+        prev_blob_snapshot = None
+        async for page in container_source.list_blobs(include=['snapshots'], results_per_page=LIST_BLOBS_PAGE_SIZE).by_page():
+            async for blob in page:
+                if blob.snapshot == None:
+                    result.blobs += 1
+                    needs_snapshot = prev_blob_name != blob.name or prev_blob_etag != blob.etag
+                    needs_backup = not backup_index.contains(blob.name, normalize_etag(blob.etag))
+                    if needs_snapshot or needs_backup:
+                        # New or changed blob without snapshot, create snapshot. Backup is requested from the
+                        # latest snapshot, which is listed just before its blob, or from the new snapshot.
+                        pending.append(snapshot_and_request_backup_async(container_source, backup_queue, blob, needs_snapshot, needs_backup,
+                                                                         None if needs_snapshot else prev_blob_snapshot, limits, result))
+
+                prev_blob_name = blob.name
+                prev_blob_etag = blob.etag
+                prev_blob_snapshot = blob.snapshot
+
+            # Wait for snapshot operations per listing page, keeps the number of outstanding coroutines bounded
+            await asyncio.gather(*pending)
+            pending = []
+
+async def snapshot_and_request_backup_async(container_source, backup_queue, blob, needs_snapshot, needs_backup, snapshot_id, limits, result):
+    if needs_snapshot:
+        async with limits.source:
+            blob_client = container_source.get_blob_client(blob.name)
+            try:
+                snapshot = await retry_on_throttle_async(blob_client.create_snapshot, etag=blob.etag, match_condition=MatchConditions.IfNotModified, stats=result.throttle)
+            except (ResourceModifiedError, ResourceNotFoundError):
+                # blob changed after listing, next run handles the new version
+                logging.info("blob " + blob.name + " changed after listing, no snapshot created")
+                return
+            snapshot_id = snapshot['snapshot']
+            result.snapshots_created += 1
+
+    if needs_backup:
+        source_etag = normalize_etag(blob.etag)
+        logging.info("backup needed for: " + container_source.container_name + "/" + blob.name + ", etag " + source_etag)
+        backup_queue.add(container_source.container_name, blob.name, source_etag, snapshot_id)
+        result.backups_requested += 1
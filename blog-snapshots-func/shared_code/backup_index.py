@@ -0,0 +1,50 @@
+import logging
+
+from azure.core.exceptions import ResourceNotFoundError
+
+from .backup_naming import parse_backup_name, normalize_etag
+
+# Maximum page size supported by the List Blobs operation
+LIST_BLOBS_PAGE_SIZE = 5000
+
+class BackupIndex:
+    # In-memory set of (blob_name, etag) keys present in a backup container
+
+    def __init__(self, container_name):
+        self.container_name = container_name
+        self.keys = set()
+        self.pages_listed = 0
+
+    def add(self, blob_name_backup):
+        parsed = parse_backup_name(blob_name_backup)
+        if parsed is None:
+            return
+        blob_name, _, etag = parsed
+        self.keys.add((blob_name, etag))
+
+    def contains(self, blob_name, etag):
+        return (blob_name, normalize_etag(etag)) in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+def build_backup_index(client_backup, container_name_backup, prefix=None, root_only=False):
+    # List backup container once using paged listing instead of probing every backup blob with get_blob_properties.
+    # Only a missing container is treated as "nothing backed up", other errors (e.g. throttling) are raised.
+    # Backups have the folder of their blob, a partition of a container only needs the backups under its prefix.
+    index = BackupIndex(container_name_backup)
+    container_backup = client_backup.get_container_client(container_name_backup)
+    if root_only:
+        blobs = container_backup.walk_blobs(name_starts_with=prefix, delimiter="/", results_per_page=LIST_BLOBS_PAGE_SIZE)
+    else:
+        blobs = container_backup.list_blobs(name_starts_with=prefix, results_per_page=LIST_BLOBS_PAGE_SIZE)
+    try:
+        for page in blobs.by_page():
+            index.pages_listed += 1
+            for blob in page:
+                index.add(blob.name)
+    except ResourceNotFoundError:
+        logging.info("backup container " + container_name_backup + " does not exist yet")
+
+    logging.info("indexed {} backups in {} using {} list calls".format(len(index), container_name_backup, index.pages_listed))
+    return index
@@ -0,0 +1,81 @@
+import base64
+import json
+import zlib
+
+# Queue messages are limited to 64 KB, base64 encoding of the queue client leaves 48 KB for the payload
+MAX_QUEUE_MESSAGE_BYTES = 64 * 1024
+MAX_PAYLOAD_BYTES = MAX_QUEUE_MESSAGE_BYTES * 3 // 4 - 1024
+# Compressed messages are packed up to this uncompressed size and split again when they do not fit
+MAX_UNCOMPRESSED_BYTES = MAX_PAYLOAD_BYTES * 8
+MESSAGE_VERSION = 2
+
+class BackupRequest:
+    # Request to back up one version of a blob, snapshot is the id of the snapshot taken of this version
+
+    __slots__ = ("container", "blob_name", "etag", "snapshot")
+
+    def __init__(self, container, blob_name, etag, snapshot=None):
+        self.container = container
+        self.blob_name = blob_name
+        self.etag = etag
+        self.snapshot = snapshot
+
+    def to_entry(self):
+        if self.snapshot is None:
+            return [self.blob_name, self.etag]
+        return [self.blob_name, self.etag, self.snapshot]
+
+    @classmethod
+    def from_entry(cls, container, entry):
+        return cls(container, entry[0], entry[1], entry[2] if len(entry) > 2 else None)
+
+def entry_size(request):
+    # size of the entry in the json list including separator
+    return len(json.dumps(request.to_entry(), separators=(",", ":")).encode("utf-8")) + 1
+
+def encode_message(container, requests, compress=False):
+    # Batched format: {"v": 2, "c": container, "b": [[blob_name, etag, snapshot], ...]}, compressed format stores
+    # the zlib compressed list base64 encoded in "z" instead of "b"
+    entries = [request.to_entry() for request in requests]
+    if not compress:
+        return json.dumps({"v": MESSAGE_VERSION, "c": container, "b": entries}, separators=(",", ":"))
+    packed = base64.b64encode(zlib.compress(json.dumps(entries, separators=(",", ":")).encode("utf-8"), 9)).decode("ascii")
+    return json.dumps({"v": MESSAGE_VERSION, "c": container, "z": packed}, separators=(",", ":"))
+
+def encode_messages(container, requests, compress=False):
+    # Pack backup requests of one container in as few messages as possible
+    limit = MAX_UNCOMPRESSED_BYTES if compress else MAX_PAYLOAD_BYTES
+    overhead = len(encode_message(container, [], False).encode("utf-8"))
+    batch = []
+    batch_size = overhead
+    for request in requests:
+        size = entry_size(request)
+        if batch and batch_size + size > limit:
+            yield from _encode_fitting(container, batch, compress)
+            batch = []
+            batch_size = overhead
+        batch.append(request)
+        batch_size += size
+    if batch:
+        yield from _encode_fitting(container, batch, compress)
+
+def _encode_fitting(container, batch, compress):
+    message = encode_message(container, batch, compress)
+    if len(message.encode("utf-8")) <= MAX_PAYLOAD_BYTES or len(batch) == 1:
+        yield message
+        return
+    # Compression ratio was lower than expected, split batch
+    middle = len(batch) // 2
+    yield from _encode_fitting(container, batch[:middle], compress)
+    yield from _encode_fitting(container, batch[middle:], compress)
+
+def decode_message(raw):
+    # Returns list of BackupRequest, supports batched messages and the single blob message of earlier versions
+    message = json.loads(raw)
+    if "v" not in message:
+        return [BackupRequest(message["container"], message["blob_name"], message["etag"].replace("\"", ""), message.get("snapshot"))]
+    if "z" in message:
+        entries = json.loads(zlib.decompress(base64.b64decode(message["z"])).decode("utf-8"))
+    else:
+        entries = message["b"]
+    return [BackupRequest.from_entry(message["c"], entry) for entry in entries]
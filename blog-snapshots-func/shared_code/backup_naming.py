@@ -0,0 +1,31 @@
+import os
+import re
+from datetime import datetime, timezone
+
+# Backup blobs are named "<name>_<source last modified>_<etag><ext>", see append_timestamp_etag
+BACKUP_NAME_PATTERN = re.compile(r"^(?P<name>.*)_(?P<modified>\d{4}-\d{2}-\d{2}[ T][^_/]*)_(?P<etag>0x[0-9A-Fa-f]+)(?P<ext>(\.[^/.]*)?)$")
+
+def append_timestamp_etag(filename, source_modified, etag):
+    name, ext = os.path.splitext(filename)
+    return "{name}_{modified}_{etag}{ext}".format(name=name, modified=source_modified, etag=etag, ext=ext)
+
+def parse_backup_name(blob_name_backup):
+    # Inverse of append_timestamp_etag, returns (blob_name, modified, etag) or None for blobs not following the naming scheme
+    match = BACKUP_NAME_PATTERN.match(blob_name_backup)
+    if match is None:
+        return None
+    return (match.group("name") + match.group("ext"), match.group("modified"), match.group("etag"))
+
+def normalize_etag(etag):
+    # Etags are returned quoted by the storage service, backup names and queue messages use them unquoted
+    return str(etag).replace("\"", "")
+
+def parse_timestamp(value):
+    # ISO 8601 timestamp of a request parameter or backup name, timestamps without timezone are UTC. None when not valid.
+    if not value:
+        return None
+    try:
+        timestamp = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return timestamp if timestamp.tzinfo is not None else timestamp.replace(tzinfo=timezone.utc)
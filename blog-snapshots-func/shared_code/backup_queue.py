@@ -0,0 +1,79 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from azure.storage.queue import QueueClient, TextBase64EncodePolicy
+
+from .backup_messages import BackupRequest, encode_messages, entry_size, MAX_PAYLOAD_BYTES, MAX_UNCOMPRESSED_BYTES
+from .metrics import bind_context, STORAGE_METRICS_HOOKS
+
+DEFAULT_MAX_CONCURRENCY_QUEUE = 16
+
+# Queue clients are reused across invocations in the same worker process
+_queue_clients_lock = threading.Lock()
+_queue_clients = {}
+
+def get_queue_client(queue_name=None):
+    queue_name = queue_name or os.environ["par_queue_name"]
+    with _queue_clients_lock:
+        if queue_name not in _queue_clients:
+            storage_account_queue_url = "https://" + os.environ["par_storage_account_name_queue"] + ".queue.core.windows.net"
+            _queue_clients[queue_name] = QueueClient(account_url=storage_account_queue_url, queue_name=queue_name,
+                                                     credential=os.environ["par_storage_account_key_queue"], message_encode_policy=TextBase64EncodePolicy(), **STORAGE_METRICS_HOOKS)
+        return _queue_clients[queue_name]
+
+class BackupRequestQueue:
+    # Buffers backup requests per container and sends them as batched messages. Full messages are sent
+    # concurrently while requests are still being added, call flush() to send the remainder and wait.
+
+    def __init__(self, queue_client, compress=None, max_concurrency=None):
+        self.queue_client = queue_client
+        self.compress = compress if compress is not None else os.environ.get("par_queue_message_compression", "false").lower() == "true"
+        # buffer is sent as soon as the next request would not fit in one message anymore
+        self.buffer_limit = (MAX_UNCOMPRESSED_BYTES if self.compress else MAX_PAYLOAD_BYTES) - 1024
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency or int(os.environ.get("par_max_concurrency_queue", DEFAULT_MAX_CONCURRENCY_QUEUE)))
+        self.lock = threading.Lock()
+        self.buffers = {}
+        self.buffer_sizes = {}
+        self.futures = []
+        self.requests_added = 0
+        self.messages_sent = 0
+
+    def add(self, container, blob_name, etag, snapshot=None):
+        request = BackupRequest(container, blob_name, etag, snapshot)
+        size = entry_size(request) + len(container)
+        with self.lock:
+            self.requests_added += 1
+            if container in self.buffers and self.buffer_sizes[container] + size > self.buffer_limit:
+                self._send_buffer(container)
+            self.buffers.setdefault(container, []).append(request)
+            self.buffer_sizes[container] = self.buffer_sizes.get(container, 0) + size
+
+    def flush(self):
+        with self.lock:
+            for container in list(self.buffers):
+                self._send_buffer(container)
+            futures = self.futures
+            self.futures = []
+        # wait for all puts before raising the exception of the first failed put
+        wait(futures)
+        for future in futures:
+            future.result()
+        return self.messages_sent
+
+    def _send_buffer(self, container):
+        requests = self.buffers.pop(container)
+        self.buffer_sizes.pop(container)
+        for message in encode_messages(container, requests, self.compress):
+            self.futures.append(self.executor.submit(bind_context(self._send_message), message))
+
+    def _send_message(self, message):
+        self.queue_client.send_message(message)
+        with self.lock:
+            self.messages_sent += 1
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown()
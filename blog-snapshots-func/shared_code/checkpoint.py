@@ -0,0 +1,127 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import zlib
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timezone
+
+from azure.core.exceptions import ResourceNotFoundError, ResourceExistsError
+
+from .clients import get_queue_account_client
+
+DEFAULT_CHECKPOINT_CONTAINER = "reconciliationcheckpoints"
+
+def digest_key(blob_name, etag):
+    # 64 bit key of a (name, etag) pair, collisions only cause a blob to be skipped until it changes again
+    return int.from_bytes(hashlib.sha1((blob_name + "\n" + etag).encode("utf-8")).digest()[:8], "big")
+
+def encode_digest(keys):
+    return base64.b64encode(zlib.compress(array("Q", sorted(keys)).tobytes())).decode("ascii")
+
+def decode_digest(encoded):
+    keys = array("Q")
+    if encoded:
+        keys.frombytes(zlib.decompress(base64.b64decode(encoded)))
+    return keys
+
+class ContainerCheckpoint:
+    # High-water mark of a container: keys of (name, etag) pairs whose snapshot and backup were present
+    # during the last complete listing pass, plus the listing position of a pass that is still running.
+
+    def __init__(self, container_name, state=None):
+        state = state or {}
+        self.container_name = container_name
+        self.last_run = state.get("last_run")
+        self.continuation_token = state.get("continuation_token")
+        self.prev_blob_name = state.get("prev_blob_name", "")
+        self.prev_blob_etag = state.get("prev_blob_etag", "")
+        self.prev_blob_snapshot = state.get("prev_blob_snapshot")
+        # sorted array of keys of the last complete pass, searched with bisect
+        self.digest = decode_digest(state.get("digest"))
+        # keys handled so far in the current pass
+        self.pass_digest = decode_digest(state.get("pass_digest"))
+
+    def is_handled(self, blob_name, etag):
+        key = digest_key(blob_name, etag)
+        position = bisect_left(self.digest, key)
+        return position < len(self.digest) and self.digest[position] == key
+
+    def mark_handled(self, blob_name, etag):
+        self.pass_digest.append(digest_key(blob_name, etag))
+
+    def complete_pass(self):
+        # Blobs that were deleted since the previous pass drop out of the digest
+        self.digest = array("Q", sorted(self.pass_digest))
+        self.pass_digest = array("Q")
+        self.continuation_token = None
+        self.prev_blob_name = ""
+        self.prev_blob_etag = ""
+        self.prev_blob_snapshot = None
+        self.last_run = datetime.now(timezone.utc).isoformat()
+
+    def to_json(self):
+        return json.dumps({
+            "container": self.container_name,
+            "last_run": self.last_run,
+            "continuation_token": self.continuation_token,
+            "prev_blob_name": self.prev_blob_name,
+            "prev_blob_etag": self.prev_blob_etag,
+            "prev_blob_snapshot": self.prev_blob_snapshot,
+            "digest": encode_digest(self.digest),
+            "pass_digest": encode_digest(self.pass_digest)
+        })
+
+class BlobCheckpointStore:
+    # Checkpoints stored as one blob per source container
+
+    def __init__(self, blob_service_client, container_name=DEFAULT_CHECKPOINT_CONTAINER):
+        self.container_client = blob_service_client.get_container_client(container_name)
+        try:
+            self.container_client.create_container()
+        except ResourceExistsError:
+            pass
+
+    def load(self, name):
+        try:
+            return json.loads(self.container_client.get_blob_client(name + ".json").download_blob().readall())
+        except ResourceNotFoundError:
+            return None
+
+    def save(self, name, state_json):
+        self.container_client.get_blob_client(name + ".json").upload_blob(state_json, overwrite=True)
+
+class FileCheckpointStore:
+    # Checkpoints stored as local files, used for tests and local runs
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def load(self, name):
+        path = os.path.join(self.directory, name + ".json")
+        if not os.path.exists(path):
+            return None
+        with open(path) as checkpoint_file:
+            return json.load(checkpoint_file)
+
+    def save(self, name, state_json):
+        with open(os.path.join(self.directory, name + ".json"), "w") as checkpoint_file:
+            checkpoint_file.write(state_json)
+
+def load_container_checkpoint(store, container_name):
+    return ContainerCheckpoint(container_name, store.load(container_name))
+
+def save_container_checkpoint(store, checkpoint):
+    store.save(checkpoint.container_name, checkpoint.to_json())
+    logging.info("checkpoint saved for container {}, {} handled blobs".format(checkpoint.container_name, len(checkpoint.digest) + len(checkpoint.pass_digest)))
+
+def create_checkpoint_store():
+    # par_checkpoint_store is "blob" (default, stored in queue storage account) or "file:<directory>"
+    location = os.environ.get("par_checkpoint_store", "blob")
+    if location.startswith("file:"):
+        return FileCheckpointStore(location[len("file:"):])
+
+    return BlobCheckpointStore(get_queue_account_client(), os.environ.get("par_checkpoint_container", DEFAULT_CHECKPOINT_CONTAINER))
@@ -0,0 +1,43 @@
+import os
+import threading
+
+from azure.identity import DefaultAzureCredential
+from azure.storage.blob import BlobServiceClient
+
+from .metrics import STORAGE_METRICS_HOOKS
+
+# Clients are created once per worker process and reused across function invocations,
+# this keeps credential token caches and the connection pools of the storage clients warm.
+_lock = threading.Lock()
+_credential = None
+_blob_service_clients = {}
+
+def get_credential():
+    global _credential
+    with _lock:
+        if _credential is None:
+            _credential = DefaultAzureCredential()
+        return _credential
+
+def get_blob_service_client(storage_account_name):
+    credential = get_credential()
+    with _lock:
+        if storage_account_name not in _blob_service_clients:
+            storage_account_url = "https://" + storage_account_name + ".blob.core.windows.net"
+            _blob_service_clients[storage_account_name] = BlobServiceClient(account_url=storage_account_url, credential=credential, **STORAGE_METRICS_HOOKS)
+        return _blob_service_clients[storage_account_name]
+
+def get_queue_account_client():
+    # Blob client of the queue storage account, used for state of the functions (checkpoints, in-flight copies)
+    storage_account_name = os.environ["par_storage_account_name_queue"]
+    with _lock:
+        if storage_account_name not in _blob_service_clients:
+            storage_account_url = "https://" + storage_account_name + ".blob.core.windows.net"
+            _blob_service_clients[storage_account_name] = BlobServiceClient(account_url=storage_account_url, credential=os.environ["par_storage_account_key_queue"], **STORAGE_METRICS_HOOKS)
+        return _blob_service_clients[storage_account_name]
+
+def get_source_client():
+    return get_blob_service_client(os.environ["par_storage_account_name_source"])
+
+def get_backup_client():
+    return get_blob_service_client(os.environ["par_storage_account_name_backup"])
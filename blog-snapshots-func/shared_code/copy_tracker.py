@@ -0,0 +1,96 @@
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+
+from .adf_client import query_pipeline_runs
+from .clients import get_queue_account_client
+from .direct_copy import ADF_SAS_VALIDITY_HOURS
+from .listing import iter_blob_records
+from .metrics import get_metrics
+from .retention import BatchDeleter
+
+# Container in the queue storage account with one record per pipeline run that was started and did not finish yet
+DEFAULT_TRACKING_CONTAINER = "backupcopies"
+# Number of run ids queried in one queryPipelineRuns request
+RUN_QUERY_BATCH_SIZE = 100
+FINISHED_RUN_STATUSES = ("Succeeded", "Failed", "Cancelled")
+# Runs that are not reported finished within the SAS validity of their source are dropped, they cannot succeed anymore
+DEFAULT_MAX_TRACKING_HOURS = ADF_SAS_VALIDITY_HOURS
+
+# Tracking container known to exist, kept across invocations in the same worker process
+_tracking_containers_lock = threading.Lock()
+_tracking_containers = set()
+
+def get_tracking_container():
+    container_name = os.environ.get("par_copy_tracking_container", DEFAULT_TRACKING_CONTAINER)
+    container_client = get_queue_account_client().get_container_client(container_name)
+    with _tracking_containers_lock:
+        if container_name in _tracking_containers:
+            return container_client
+    try:
+        container_client.create_container()
+    except ResourceExistsError:
+        pass
+    with _tracking_containers_lock:
+        _tracking_containers.add(container_name)
+    return container_client
+
+def register_copy(container_source, run_id, blob_names_backup):
+    # Record of a started pipeline run, named by run id. Container, blob count and start time are kept in metadata so the
+    # tracker reads all records with one listing, the backup names are only downloaded when the run did not succeed.
+    metadata = {"container": container_source, "blobs": str(len(blob_names_backup)), "started": datetime.now(timezone.utc).isoformat()}
+    get_tracking_container().get_blob_client(run_id).upload_blob(json.dumps(blob_names_backup), overwrite=True, metadata=metadata)
+
+def track_copies():
+    # Polls the status of all registered pipeline runs in batches and records the outcome of the finished runs.
+    # Backups of failed runs are missing in the backup container and are requested again by the next reconciliation.
+    tracking_container = get_tracking_container()
+    records = list(iter_blob_records(tracking_container, include_metadata=True))
+    result = {"in_flight": 0, "succeeded": 0, "failed": 0, "cancelled": 0, "lost": 0}
+    if not records:
+        return result
+
+    runs = {}
+    updated_after = min(get_started(record) for record in records) - timedelta(minutes=5)
+    for start in range(0, len(records), RUN_QUERY_BATCH_SIZE):
+        for run in query_pipeline_runs([record.name for record in records[start:start + RUN_QUERY_BATCH_SIZE]], updated_after):
+            runs[run["runId"]] = run
+
+    max_tracking_time = timedelta(hours=int(os.environ.get("par_copy_tracking_max_hours", DEFAULT_MAX_TRACKING_HOURS)))
+    now = datetime.now(timezone.utc)
+    deleter = BatchDeleter(tracking_container)
+    for record in records:
+        run = runs.get(record.name)
+        status = run["status"] if run is not None else None
+        if status in FINISHED_RUN_STATUSES:
+            get_metrics().count("adf.run_" + status.lower())
+            if run.get("durationInMs") is not None:
+                get_metrics().observe("adf.copy", run["durationInMs"] / 1000)
+            if status != "Succeeded":
+                log_unfinished_copy(tracking_container, record, status + ": " + str(run.get("message")))
+            result[status.lower()] += 1
+        elif now - get_started(record) > max_tracking_time:
+            get_metrics().count("adf.run_lost")
+            log_unfinished_copy(tracking_container, record, "no final status after {}".format(max_tracking_time))
+            result["lost"] += 1
+        else:
+            result["in_flight"] += 1
+            continue
+        deleter.delete(record.name)
+    deleter.close()
+    return result
+
+def get_started(record):
+    return datetime.fromisoformat(record.metadata["started"])
+
+def log_unfinished_copy(tracking_container, record, reason):
+    try:
+        blob_names_backup = json.loads(tracking_container.get_blob_client(record.name).download_blob().readall())
+    except ResourceNotFoundError:
+        blob_names_backup = []
+    logging.info("pipeline run {} copying {} blobs of container {} did not succeed ({}), backups not created: {}".format(
+        record.name, record.metadata.get("blobs"), record.metadata.get("container"), reason, ", ".join(blob_names_backup)))
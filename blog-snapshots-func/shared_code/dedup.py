@@ -0,0 +1,62 @@
+import hashlib
+import logging
+import os
+
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from azure.storage.blob import ContentSettings
+
+# Content index of a backup container: one empty marker blob per content hash, its metadata names the backup holding the content
+DEDUP_INDEX_PREFIX = "_dedup/"
+# Metadata of a marker blob naming the backup that holds the content
+DEDUP_TARGET_METADATA = "backup_blob"
+# Metadata of a backup that is a reference to another backup with the same content
+DEDUP_REF_METADATA = "dedup_ref"
+# Blobs without Content-MD5 (e.g. written through the DFS endpoint or in blocks) are downloaded and hashed by the
+# function up to this size. Default only deduplicates on the Content-MD5 returned by the service.
+DEFAULT_DEDUP_HASH_MAX_BYTES = 0
+
+def get_content_hash(blob_snapshot, blob_snapshot_properties):
+    # Hex MD5 of the content, from Content-MD5 of the blob or computed for small blobs. None when unknown.
+    content_md5 = blob_snapshot_properties.content_settings.content_md5
+    if content_md5:
+        return bytes(content_md5).hex()
+    if blob_snapshot_properties.size > int(os.environ.get("par_dedup_hash_max_bytes", DEFAULT_DEDUP_HASH_MAX_BYTES)):
+        return None
+    md5 = hashlib.md5()
+    for chunk in blob_snapshot.download_blob().chunks():
+        md5.update(chunk)
+    return md5.hexdigest()
+
+def find_backup_with_content(client_backup, container_name_backup, content_hash):
+    # Name of an existing backup with this content, or None. Marker and backup are checked on every call (not cached),
+    # retention deletes the marker of an expired backup before it deletes the backup itself.
+    try:
+        marker_properties = client_backup.get_blob_client(container=container_name_backup, blob=DEDUP_INDEX_PREFIX + content_hash).get_blob_properties()
+        blob_name_backup = marker_properties.metadata[DEDUP_TARGET_METADATA]
+        # backup registered for a copy that never finished (e.g. failed pipeline run) does not count
+        client_backup.get_blob_client(container=container_name_backup, blob=blob_name_backup).get_blob_properties()
+    except (ResourceNotFoundError, KeyError):
+        return None
+    return blob_name_backup
+
+def register_backup_content(client_backup, container_name_backup, content_hash, blob_name_backup):
+    # First backup with a content hash becomes the target of later references
+    marker = client_backup.get_blob_client(container=container_name_backup, blob=DEDUP_INDEX_PREFIX + content_hash)
+    try:
+        marker.upload_blob(b"", metadata={DEDUP_TARGET_METADATA: blob_name_backup}, overwrite=False)
+    except ResourceExistsError:
+        # marker of a backup that was deleted by retention is replaced
+        if find_backup_with_content(client_backup, container_name_backup, content_hash) is None:
+            marker.upload_blob(b"", metadata={DEDUP_TARGET_METADATA: blob_name_backup}, overwrite=True)
+
+def write_backup_reference(client_backup, container_name_backup, blob_name_backup, content_hash, blob_name_target):
+    # Empty backup blob that refers to the backup with the same content, restore resolves the reference
+    blob_backup = client_backup.get_blob_client(container=container_name_backup, blob=blob_name_backup)
+    blob_backup.upload_blob(b"", overwrite=True,
+                            metadata={DEDUP_REF_METADATA: blob_name_target, "content_md5": content_hash},
+                            content_settings=ContentSettings(content_md5=bytearray.fromhex(content_hash)))
+    logging.info("content of {} already in backup as {}, reference written".format(blob_name_backup, blob_name_target))
+
+def resolve_backup_reference(blob_backup_properties):
+    # Name of the backup holding the content of a backup blob
+    return (blob_backup_properties.metadata or {}).get(DEDUP_REF_METADATA, blob_backup_properties.name)
@@ -0,0 +1,94 @@
+import hashlib
+import json
+import logging
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from azure.storage.blob import BlobBlock, ContentSettings
+
+from .direct_copy import get_source_url
+from .metrics import bind_context
+
+# Large blobs are backed up as chunks in a content addressed chunk store of the backup container plus a manifest per version.
+# Chunks that did not change since the previous backup of the blob are not uploaded again.
+DELTA_CHUNK_PREFIX = "_chunks/"
+# Name of the manifest of the latest delta backup of a blob, kept under this prefix per blob
+DELTA_LATEST_PREFIX = "_delta/"
+DELTA_MANIFEST_METADATA = "delta_manifest"
+DELTA_MANIFEST_VERSION = 1
+DEFAULT_DELTA_CHUNK_BYTES = 4 * 1024 * 1024
+DEFAULT_DELTA_MIN_BYTES = 1024 * 1024 * 1024
+DEFAULT_DELTA_CONCURRENCY = 8
+
+def use_delta_backup(size):
+    return size >= int(os.environ.get("par_delta_min_bytes", DEFAULT_DELTA_MIN_BYTES))
+
+def get_chunk_name(digest):
+    return DELTA_CHUNK_PREFIX + digest
+
+def is_delta_manifest(blob_backup_properties):
+    return DELTA_MANIFEST_METADATA in (blob_backup_properties.metadata or {})
+
+def read_delta_manifest(blob_backup):
+    return json.loads(blob_backup.download_blob().readall())
+
+def read_latest_chunks(client_backup, container_name_backup, blob_name):
+    # Chunk digests of the previous delta backup of the blob, empty when there is none
+    try:
+        blob_name_manifest = client_backup.get_blob_client(container=container_name_backup, blob=DELTA_LATEST_PREFIX + blob_name).download_blob().readall().decode('utf-8')
+        manifest = read_delta_manifest(client_backup.get_blob_client(container=container_name_backup, blob=blob_name_manifest))
+    except ResourceNotFoundError:
+        return set()
+    return set(manifest["chunks"])
+
+def backup_blob_delta(client_source, client_backup, container_name, blob_name, blob_name_backup, size, snapshot):
+    # Backs up the snapshot as changed chunks plus a manifest at blob_name_backup, returns the number of bytes uploaded
+    container_name_backup = container_name + "bak"
+    chunk_size = int(os.environ.get("par_delta_chunk_bytes", DEFAULT_DELTA_CHUNK_BYTES))
+    max_workers = int(os.environ.get("par_delta_concurrency", DEFAULT_DELTA_CONCURRENCY))
+    known_chunks = read_latest_chunks(client_backup, container_name_backup, blob_name)
+    blob_snapshot = client_source.get_blob_client(container=container_name, blob=blob_name, snapshot=snapshot)
+
+    def backup_chunk(offset):
+        # Chunks are read from the immutable snapshot and hashed by the function, unchanged chunks are not uploaded
+        data = blob_snapshot.download_blob(offset=offset, length=min(chunk_size, size - offset)).readall()
+        digest = hashlib.sha256(data).hexdigest()
+        if digest in known_chunks:
+            return digest, 0
+        try:
+            client_backup.get_blob_client(container=container_name_backup, blob=get_chunk_name(digest)).upload_blob(data, overwrite=False)
+        except ResourceExistsError:
+            # chunk was stored by a backup of another blob or version
+            return digest, 0
+        return digest, len(data)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        chunks = list(executor.map(bind_context(backup_chunk), range(0, size, chunk_size)))
+
+    # Manifest is written after all chunks, a version is only visible in backup when it can be restored
+    manifest = {"v": DELTA_MANIFEST_VERSION, "size": size, "chunk_size": chunk_size, "chunks": [digest for digest, _ in chunks]}
+    client_backup.get_blob_client(container=container_name_backup, blob=blob_name_backup).upload_blob(
+        json.dumps(manifest, separators=(',', ':')), overwrite=True, metadata={DELTA_MANIFEST_METADATA: str(DELTA_MANIFEST_VERSION)},
+        content_settings=ContentSettings(content_type="application/json"))
+    client_backup.get_blob_client(container=container_name_backup, blob=DELTA_LATEST_PREFIX + blob_name).upload_blob(blob_name_backup, overwrite=True)
+
+    bytes_uploaded = sum(uploaded for _, uploaded in chunks)
+    logging.info("delta backup of {} to {}: {} of {} bytes uploaded".format(blob_name, blob_name_backup, bytes_uploaded, size))
+    return bytes_uploaded
+
+def restore_delta_version(client_backup, container_name_backup, blob_name_backup, blob_target):
+    # Reassembles a version from its manifest, chunks are copied server-side into blocks of the target blob
+    manifest = read_delta_manifest(client_backup.get_blob_client(container=container_name_backup, blob=blob_name_backup))
+    max_workers = int(os.environ.get("par_delta_concurrency", DEFAULT_DELTA_CONCURRENCY))
+    block_ids = [str(uuid.uuid4()) for _ in manifest["chunks"]]
+
+    def restore_chunk(block_id, digest):
+        blob_target.stage_block_from_url(block_id, get_source_url(client_backup, container_name_backup, get_chunk_name(digest)))
+
+    if block_ids:
+        with ThreadPoolExecutor(max_workers=min(len(block_ids), max_workers)) as executor:
+            list(executor.map(bind_context(restore_chunk), block_ids, manifest["chunks"]))
+    blob_target.commit_block_list([BlobBlock(block_id=block_id) for block_id in block_ids])
+    logging.info("restored {} from {} chunks".format(blob_name_backup, len(block_ids)))
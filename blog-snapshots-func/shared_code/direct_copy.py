@@ -0,0 +1,77 @@
+import logging
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from azure.storage.blob import BlobSasPermissions, BlobBlock, generate_blob_sas
+
+from .metrics import bind_context
+
+# Blobs up to this size are copied directly by the function instead of by an ADFv2 pipeline
+DEFAULT_DIRECT_COPY_MAX_BYTES = 1024 * 1024 * 1024
+# Copy Blob From URL copies synchronously up to 256 MiB, larger blobs are copied in blocks using Put Block From URL
+SYNC_COPY_MAX_BYTES = 256 * 1024 * 1024
+COPY_BLOCK_SIZE = 100 * 1024 * 1024
+DEFAULT_BLOCK_COPY_CONCURRENCY = 8
+# User delegation key is valid for two days and replaced before the remaining validity is shorter than a SAS
+USER_DELEGATION_KEY_HOURS = 48
+SAS_VALIDITY_HOURS = 1
+# ADFv2 runs can be queued before the copy starts, their SAS urls are valid longer. Queue wait plus copy
+# duration of an ADFv2 run must stay within this validity, the copy fails with 403 when the SAS expires.
+ADF_SAS_VALIDITY_HOURS = 12
+
+_key_lock = threading.Lock()
+_user_delegation_keys = {}
+
+def use_direct_copy(size):
+    return size <= int(os.environ.get("par_direct_copy_max_bytes", DEFAULT_DIRECT_COPY_MAX_BYTES))
+
+def get_user_delegation_key(client_source):
+    # Key to sign SAS tokens with the Azure AD identity of the function, cached per storage account
+    now = datetime.now(timezone.utc)
+    with _key_lock:
+        cached = _user_delegation_keys.get(client_source.account_name)
+        if cached is not None and cached[1] - now > timedelta(hours=ADF_SAS_VALIDITY_HOURS + 1):
+            return cached[0]
+        expiry = now + timedelta(hours=USER_DELEGATION_KEY_HOURS)
+        user_delegation_key = client_source.get_user_delegation_key(now - timedelta(minutes=5), expiry)
+        _user_delegation_keys[client_source.account_name] = (user_delegation_key, expiry)
+        return user_delegation_key
+
+def get_source_url(client_source, container_name, blob_name, snapshot=None, validity_hours=SAS_VALIDITY_HOURS):
+    # Read-only SAS url of the source blob or snapshot, the backup account (or ADFv2) reads the source using this url
+    sas_token = generate_blob_sas(
+        client_source.account_name, container_name, blob_name, snapshot=snapshot,
+        user_delegation_key=get_user_delegation_key(client_source),
+        permission=BlobSasPermissions(read=True),
+        expiry=datetime.now(timezone.utc) + timedelta(hours=validity_hours))
+    blob_url = client_source.get_blob_client(container=container_name, blob=blob_name, snapshot=snapshot).url
+    return blob_url + ("&" if "?" in blob_url else "?") + sas_token
+
+def copy_blob_direct(client_source, client_backup, container_name, blob_name, blob_name_backup, size, snapshot):
+    # Server-side copy of the source snapshot to the backup container, snapshots are immutable so no source conditions are needed
+    source_url = get_source_url(client_source, container_name, blob_name, snapshot)
+    blob_backup = client_backup.get_blob_client(container=container_name + "bak", blob=blob_name_backup)
+    copy_url_to_blob(blob_backup, source_url, size)
+    logging.info("blob {} copied to {} using server-side copy".format(blob_name, blob_name_backup))
+
+def copy_url_to_blob(blob_target, source_url, size):
+    # Server-side copy of an immutable source (snapshot or backup) to the target blob
+    if size <= SYNC_COPY_MAX_BYTES:
+        blob_target.start_copy_from_url(source_url, requires_sync=True)
+        return
+    blob_target.commit_block_list([BlobBlock(block_id=block_id) for block_id in stage_blocks_from_url(blob_target, source_url, size)])
+
+def stage_blocks_from_url(blob_target, source_url, size):
+    # Stage blocks of the destination from ranges of the source in parallel, returns the block ids in order
+    block_ids = [str(uuid.uuid4()) for _ in range(0, size, COPY_BLOCK_SIZE)]
+    max_workers = min(len(block_ids), int(os.environ.get("par_block_copy_concurrency", DEFAULT_BLOCK_COPY_CONCURRENCY)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(bind_context(blob_target.stage_block_from_url), block_id, source_url,
+                                   source_offset=index * COPY_BLOCK_SIZE, source_length=min(COPY_BLOCK_SIZE, size - index * COPY_BLOCK_SIZE))
+                   for index, block_id in enumerate(block_ids)]
+        for future in futures:
+            future.result()
+    return block_ids
@@ -0,0 +1,131 @@
+import heapq
+import logging
+from collections import OrderedDict
+
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import BlobPrefix
+
+from .backup_index import LIST_BLOBS_PAGE_SIZE
+from .backup_naming import normalize_etag, parse_backup_name
+
+# Backups are listed in order of their backup name, which differs from the order of the blob names
+# (e.g. backups of a.csv and a.txt interleave). The reorder window sorts backups locally on blob name.
+DEFAULT_REORDER_WINDOW = 1000
+# Misses of the merge-join wait for backups that are listed later than their blob, e.g. the backup of file1.csv is
+# listed after the backups of file10.csv to file19999.csv. The oldest miss is reported when more are waiting.
+DEFAULT_PENDING_MISSES = 10000
+
+class BlobRecord:
+    # Compact record of a listed blob or snapshot, replaces the BlobProperties objects of the SDK while iterating.
+    # Fields can be read as attributes or as keys, like BlobProperties. Metadata is only kept when it was listed.
+    __slots__ = ("name", "etag", "last_modified", "size", "snapshot", "metadata")
+
+    def __init__(self, name, etag, last_modified, size, snapshot=None, metadata=None):
+        self.name = name
+        self.etag = etag
+        self.last_modified = last_modified
+        self.size = size
+        self.snapshot = snapshot
+        self.metadata = metadata
+
+    @classmethod
+    def from_blob(cls, blob):
+        return cls(blob.name, blob.etag, blob.last_modified, blob.size, blob.snapshot, blob.metadata or None)
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+class BlobRecordPages:
+    # Pages of BlobRecords of a listing, continuation_token is the position after the last page that was iterated
+
+    def __init__(self, container_client, prefix=None, include_snapshots=False, root_only=False, continuation_token=None, include_metadata=False):
+        include = (['snapshots'] if include_snapshots else []) + (['metadata'] if include_metadata else []) or None
+        if root_only:
+            # Blobs directly in the container or in the prefix folder, subfolders are skipped
+            blobs = container_client.walk_blobs(name_starts_with=prefix, include=include, delimiter="/", results_per_page=LIST_BLOBS_PAGE_SIZE)
+        else:
+            blobs = container_client.list_blobs(name_starts_with=prefix, include=include, results_per_page=LIST_BLOBS_PAGE_SIZE)
+        self.pages = blobs.by_page(continuation_token=continuation_token)
+
+    @property
+    def continuation_token(self):
+        return self.pages.continuation_token
+
+    def __iter__(self):
+        for page in self.pages:
+            # records are created while the page is iterated, only the page of the SDK is held in memory
+            yield (BlobRecord.from_blob(blob) for blob in page if not isinstance(blob, BlobPrefix))
+
+def iter_blob_records(container_client, prefix=None, include_snapshots=False, root_only=False, include_metadata=False):
+    for page in BlobRecordPages(container_client, prefix, include_snapshots, root_only, include_metadata=include_metadata):
+        yield from page
+
+def iter_backup_keys(container_client_backup, prefix=None, root_only=False, window=DEFAULT_REORDER_WINDOW):
+    # Yields (blob_name, etag) of the backups in the container, sorted on blob name within the reorder window
+    heap = []
+    try:
+        for record in iter_blob_records(container_client_backup, prefix, root_only=root_only):
+            parsed = parse_backup_name(record.name)
+            if parsed is None:
+                continue
+            heapq.heappush(heap, (parsed[0], parsed[2]))
+            if len(heap) > window:
+                yield heapq.heappop(heap)
+    except ResourceNotFoundError:
+        logging.info("backup container " + container_client_backup.container_name + " does not exist yet")
+    while heap:
+        yield heapq.heappop(heap)
+
+class BackupMergeJoin:
+    # Sorted merge-join of the source listing with the backup listing in constant memory.
+    # contains() is called with blob names in listing order. A blob whose backup is not found yet is passed to
+    # defer(), its backup request is returned by defer() or finish() when the backup is not listed later on.
+    # A backup that is read out of order beyond the pending misses only causes a redundant backup request.
+
+    def __init__(self, client_backup, container_name_backup, prefix=None, root_only=False, max_pending=DEFAULT_PENDING_MISSES):
+        self.container_name = container_name_backup
+        self.keys = iter_backup_keys(client_backup.get_container_client(container_name_backup), prefix, root_only)
+        self.head = None
+        self.exhausted = False
+        self.backups_read = 0
+        self.pending = OrderedDict()
+        self.max_pending = max_pending
+        self.late_matches = 0
+
+    def _advance(self):
+        self.head = next(self.keys, None)
+        if self.head is None:
+            self.exhausted = True
+            return
+        self.backups_read += 1
+        if self.pending and self.pending.pop(self.head, None) is not None:
+            # backup listed later than its blob, no backup request needed
+            self.late_matches += 1
+
+    def contains(self, blob_name, etag):
+        key = (blob_name, normalize_etag(etag))
+        if self.head is None and not self.exhausted:
+            self._advance()
+        # backups of blobs before this blob (deleted blobs) and of other versions are skipped
+        while not self.exhausted and self.head < key:
+            self._advance()
+        return not self.exhausted and self.head == key
+
+    def defer(self, blob_name, etag, request):
+        # Returns the requests of misses that are not waited for anymore
+        self.pending[(blob_name, normalize_etag(etag))] = request
+        reported = []
+        while len(self.pending) > self.max_pending:
+            reported.append(self.pending.popitem(last=False)[1])
+        return reported
+
+    def finish(self, read_remaining=True):
+        # Requests of the misses whose backup was not listed. The rest of the backup listing is only read for a
+        # complete listing of the source, a run that stops early reports its pending misses as they are.
+        while read_remaining and self.pending and not self.exhausted:
+            self._advance()
+        reported = list(self.pending.values())
+        self.pending.clear()
+        if self.late_matches:
+            logging.info("{} backups in {} were listed after their blob".format(self.late_matches, self.container_name))
+        return reported
@@ -0,0 +1,163 @@
+import contextvars
+import json
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from urllib.parse import parse_qs, urlparse
+
+# Upper bounds of the latency histogram buckets in seconds, the last bucket is unbounded
+LATENCY_BUCKETS_SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+class Histogram:
+    __slots__ = ("count", "total", "buckets")
+
+    def __init__(self, count=0, total=0.0, buckets=None):
+        self.count = count
+        self.total = total
+        self.buckets = buckets or [0] * (len(LATENCY_BUCKETS_SECONDS) + 1)
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        for index, bound in enumerate(LATENCY_BUCKETS_SECONDS):
+            if value <= bound:
+                self.buckets[index] += 1
+                return
+        self.buckets[-1] += 1
+
+    def copy(self):
+        return Histogram(self.count, self.total, list(self.buckets))
+
+    def quantile(self, fraction):
+        # Upper bound of the bucket holding the quantile
+        rank = fraction * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                return LATENCY_BUCKETS_SECONDS[index] if index < len(LATENCY_BUCKETS_SECONDS) else None
+        return None
+
+    def to_dict(self):
+        return {"count": self.count, "mean": round(self.total / self.count, 4) if self.count else None,
+                "p50": self.quantile(0.5), "p95": self.quantile(0.95), "buckets": self.buckets}
+
+class Metrics:
+    # Counters and latency histograms, of one invocation (see InvocationMetrics) or of the worker process
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        self.histograms = {}
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def snapshot(self):
+        with self.lock:
+            return Counter(self.counters), {name: histogram.copy() for name, histogram in self.histograms.items()}
+
+# Metrics recorded outside of an invocation, e.g. during module import
+_metrics = Metrics()
+# Metrics of the invocation running in the current context
+_invocation = contextvars.ContextVar("invocation_metrics", default=None)
+
+def get_metrics():
+    invocation = _invocation.get()
+    return invocation if invocation is not None else _metrics
+
+def bind_context(function):
+    # Runs function in a copy of the caller's context, so calls on executor threads are recorded in the metrics
+    # of the invocation that submitted them. Every call gets its own copy, a context cannot be entered twice at once.
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return context.copy().run(function, *args, **kwargs)
+    return run
+
+class InvocationMetrics(Metrics):
+    # Metrics recorded during one function invocation. Invocations running at the same time in one worker process
+    # run in their own context, work they submit to executor threads is bound to it with bind_context().
+
+    def __init__(self, function_name):
+        super().__init__()
+        self.function_name = function_name
+        self.started = time.perf_counter()
+        _invocation.set(self)
+
+    def summary(self):
+        counters, histograms = self.snapshot()
+        return {
+            "function": self.function_name,
+            "duration_seconds": round(time.perf_counter() - self.started, 3),
+            "counters": dict(sorted(counters.items())),
+            "latency_seconds": {name: histogram.to_dict() for name, histogram in sorted(histograms.items())}
+        }
+
+    def log(self):
+        # One structured line per invocation, can be parsed from the function logs (e.g. in Application Insights)
+        summary = self.summary()
+        logging.info("metrics " + json.dumps(summary, separators=(',', ':')))
+        return summary
+
+def classify_storage_request(http_request):
+    # Name of the storage operation of a REST request, e.g. list_blobs, snapshot_blob or put_message
+    query = parse_qs(urlparse(http_request.url).query)
+    comp = query.get("comp", [None])[0]
+    restype = query.get("restype", [None])[0]
+    method = http_request.method
+    copy_source = "x-ms-copy-source" in http_request.headers
+    if ".queue." in http_request.url:
+        return {"POST": "put_message", "GET": "get_messages", "PUT": "create_queue"}.get(method, "queue_" + method.lower())
+    if comp == "list":
+        return "list_blobs" if restype == "container" else "list_containers"
+    if comp == "batch":
+        return "blob_batch"
+    if comp == "userdelegationkey":
+        return "get_user_delegation_key"
+    if method == "PUT":
+        if restype == "container":
+            return "create_container"
+        if comp == "block":
+            return "put_block_from_url" if copy_source else "put_block"
+        if comp in ("snapshot", "blocklist", "metadata", "lease"):
+            return {"snapshot": "snapshot_blob", "blocklist": "put_block_list", "metadata": "set_metadata", "lease": "lease_blob"}[comp]
+        return "copy_blob" if copy_source else "put_blob"
+    return {"HEAD": "get_blob_properties", "GET": "get_blob", "DELETE": "delete_blob"}.get(method, method.lower())
+
+def storage_request_hook(request):
+    request.context["metrics_started"] = time.perf_counter()
+
+def storage_response_hook(response):
+    # Called for every attempt, throttled attempts are counted separately
+    operation = classify_storage_request(response.http_request)
+    started = response.context.get("metrics_started")
+    metrics = get_metrics()
+    metrics.count("storage." + operation)
+    if response.http_response.status_code == 503:
+        metrics.count("storage.throttled")
+    if started is not None:
+        now = time.perf_counter()
+        metrics.observe("storage." + operation, now - started)
+        response.context["metrics_started"] = now
+
+# Keyword arguments of the storage clients that record every storage request in the metrics
+STORAGE_METRICS_HOOKS = {"raw_request_hook": storage_request_hook, "raw_response_hook": storage_response_hook}
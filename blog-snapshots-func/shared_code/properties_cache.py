@@ -0,0 +1,34 @@
+from collections import OrderedDict
+
+# Bound on cached entries, listings of large containers should not be held in memory completely
+MAX_CACHED_PROPERTIES = 10000
+
+class BlobPropertiesCache:
+    # Per-run cache of blob properties. Entries are primed from list_blobs results, so follow-up
+    # lookups of listed blobs do not need a get_blob_properties round-trip to the storage account.
+
+    def __init__(self, max_entries=MAX_CACHED_PROPERTIES):
+        self.properties = OrderedDict()
+        self.max_entries = max_entries
+        self.calls_issued = 0
+        self.calls_saved = 0
+
+    def prime(self, container_name, blob):
+        self._put((container_name, blob.name, blob.snapshot), blob)
+
+    def get(self, blob_client):
+        key = (blob_client.container_name, blob_client.blob_name, blob_client.snapshot)
+        if key in self.properties:
+            self.calls_saved += 1
+            self.properties.move_to_end(key)
+            return self.properties[key]
+        self.calls_issued += 1
+        blob_properties = blob_client.get_blob_properties()
+        self._put(key, blob_properties)
+        return blob_properties
+
+    def _put(self, key, blob_properties):
+        self.properties[key] = blob_properties
+        self.properties.move_to_end(key)
+        if len(self.properties) > self.max_entries:
+            self.properties.popitem(last=False)
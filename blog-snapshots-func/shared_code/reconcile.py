@@ -0,0 +1,126 @@
+import logging
+import time
+
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceModifiedError, ResourceNotFoundError
+
+from .backup_index import build_backup_index
+from .backup_naming import normalize_etag
+from .checkpoint import save_container_checkpoint
+from .listing import BackupMergeJoin, BlobRecordPages
+
+CHECKPOINT_INTERVAL_PAGES = 20
+# Check backups with a merge-join of the sorted source and backup listings (constant memory) instead of an index of the backup container
+USING_MERGE_JOIN = True
+
+def reconcile_container(client_source, client_backup, backup_queue, container_name, properties_cache, using_listing_properties, checkpoint, checkpoint_store, deadline, prefix=None, root_only=False):
+    # Returns False when the time budget ran out before the container was completely listed.
+    # With prefix or root_only only a partition of the container is reconciled (see shared_code/sharding.py).
+    container_source = client_source.get_container_client(container_name)
+
+    # List backup container once, existence checks of backups are lookups in this index or a merge-join with the listing.
+    # Index is built on first use, incremental runs without changes do not list the backup container.
+    backup_index = None
+
+    # Get all blobs in container, resume from checkpoint if previous run was interrupted
+    prev_blob_name = checkpoint.prev_blob_name if checkpoint else ""
+    prev_blob_etag = checkpoint.prev_blob_etag if checkpoint else ""
+    prev_blob_snapshot = checkpoint.prev_blob_snapshot if checkpoint else None
+    continuation_token = checkpoint.continuation_token if checkpoint else None
+    # With root_only only the blobs directly in the container are listed, folders are reconciled in partitions of their own
+    blob_pages = BlobRecordPages(container_source, prefix, include_snapshots=True, root_only=root_only, continuation_token=continuation_token)
+    pages_listed = 0
+    for blob_page in blob_pages:
+        for blob in blob_page:
+            if using_listing_properties:
+                properties_cache.prime(container_name, blob)
+
+            if blob.snapshot == None and checkpoint is not None and checkpoint.is_handled(blob.name, normalize_etag(blob.etag)):
+                # Snapshot and backup of this version were already present in a previous run
+                checkpoint.mark_handled(blob.name, normalize_etag(blob.etag))
+
+            elif blob.snapshot == None:
+                # Blob that is not snapshot.
+                # 1. Check if snapshot needs to be created
+                # Latest snapshot is listed just before its blob and has the etag of the blob at snapshot time
+                snapshot_exists = True
+                snapshot_id = prev_blob_snapshot
+                if prev_blob_name != blob.name:
+                    # New blob without snapshot, create snapshot/backup
+                    logging.info("new blob" + blob.name + ", create snapshot/backup")
+                    snapshot_id = create_snapshot(client_source, container_name, blob.name, blob.etag)
+                    snapshot_exists = False
+                elif prev_blob_etag != blob.etag:
+                    # Existing blob that has changed, create snapshot/backup
+                    logging.info(blob.name + "has changed, create snapshot/backup")
+                    snapshot_id = create_snapshot(client_source, container_name, blob.name, blob.etag)
+                    snapshot_exists = False
+
+                # 2. Check if incremental backup needs to be created
+                # get blob backup and source properties
+                # in listing mode the cache is primed by list_blobs and no HEAD request is sent
+                blob_source = client_source.get_blob_client(container=container_name, blob=blob.name)
+                source_last_modified = properties_cache.get(blob_source)['last_modified']
+                source_etag = normalize_etag(properties_cache.get(blob_source)['etag'])
+                if backup_index is None and USING_MERGE_JOIN:
+                    backup_index = BackupMergeJoin(client_backup, container_name + "bak", prefix, root_only)
+                elif backup_index is None:
+                    backup_index = build_backup_index(client_backup, container_name + "bak", prefix, root_only)
+                blob_exists = backup_index.contains(blob.name, source_etag)
+                # Check if blob exists
+                if blob_exists == False:
+                    # Latest blob does not yet exist in backup, create message on queue to update
+                    logging.info("backup needed for: " + container_name + "/" + blob.name + ", etag " + source_etag)
+                    # backup is copied from the snapshot of this version, the worker snapshots the blob if there is none
+                    if source_etag != normalize_etag(blob.etag):
+                        snapshot_id = None
+                    if USING_MERGE_JOIN:
+                        # the backup can still be listed later than the blob, the request is sent when it is not
+                        for request in backup_index.defer(blob.name, source_etag, (container_name, blob.name, source_etag, snapshot_id)):
+                            backup_queue.add(*request)
+                    else:
+                        backup_queue.add(container_name, blob.name, source_etag, snapshot_id)
+                    #asyncio.run(copy_adf_blob_source_backup(blob_source, blob_backup))
+                elif checkpoint is not None and snapshot_exists:
+                    # Only versions with snapshot and backup in place are skipped by later runs,
+                    # enqueued backups are checked again in the next run
+                    checkpoint.mark_handled(blob.name, source_etag)
+
+            prev_blob_name = blob.name
+            prev_blob_etag = blob.etag
+            prev_blob_snapshot = blob.snapshot
+
+        if checkpoint is None:
+            continue
+        pages_listed += 1
+        checkpoint.continuation_token = blob_pages.continuation_token
+        checkpoint.prev_blob_name = prev_blob_name
+        checkpoint.prev_blob_etag = prev_blob_etag
+        checkpoint.prev_blob_snapshot = prev_blob_snapshot
+        if checkpoint.continuation_token and time.time() > deadline:
+            send_deferred_requests(backup_queue, backup_index, False)
+            save_container_checkpoint(checkpoint_store, checkpoint)
+            logging.info("time budget exceeded, container " + container_name + " will be resumed in next run")
+            return False
+        if pages_listed % CHECKPOINT_INTERVAL_PAGES == 0:
+            save_container_checkpoint(checkpoint_store, checkpoint)
+
+    send_deferred_requests(backup_queue, backup_index, True)
+    if checkpoint is not None:
+        checkpoint.complete_pass()
+        save_container_checkpoint(checkpoint_store, checkpoint)
+    return True
+
+def send_deferred_requests(backup_queue, backup_index, read_remaining):
+    if backup_index is not None and USING_MERGE_JOIN:
+        for request in backup_index.finish(read_remaining):
+            backup_queue.add(*request)
+
+def create_snapshot(client_source, container_name, blob_name, blob_etag):
+    # create snapshot of the listed version, returns snapshot id or None when the blob changed after listing
+    blob_client = client_source.get_blob_client(container=container_name, blob=blob_name)
+    try:
+        return blob_client.create_snapshot(etag=blob_etag, match_condition=MatchConditions.IfNotModified)['snapshot']
+    except (ResourceModifiedError, ResourceNotFoundError):
+        logging.info("blob " + blob_name + " changed after listing, no snapshot created")
+        return None
\ No newline at end of file
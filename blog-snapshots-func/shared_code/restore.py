@@ -0,0 +1,154 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from azure.core.exceptions import ResourceExistsError
+
+from .backup_naming import parse_backup_name
+from .dedup import DEDUP_REF_METADATA
+from .delta_backup import is_delta_manifest, restore_delta_version
+from .direct_copy import copy_url_to_blob, get_source_url
+from .listing import iter_blob_records
+from .metrics import bind_context
+from .retention import parse_backup_time
+from .throttling import retry_on_throttle, ThrottleStats
+
+DEFAULT_RESTORE_CONCURRENCY = 32
+RESTORE_PROGRESS_INTERVAL = 100
+
+class RestoreItem:
+    # Version of a blob to restore, either a snapshot in the source account or a backup in the backup account
+    __slots__ = ("blob_name", "last_modified", "size", "snapshot", "blob_name_backup", "dedup_ref", "delta_manifest")
+
+    def __init__(self, blob_name, last_modified, size, snapshot=None, blob_name_backup=None, dedup_ref=None, delta_manifest=False):
+        self.blob_name = blob_name
+        self.last_modified = last_modified
+        self.size = size
+        self.snapshot = snapshot
+        self.blob_name_backup = blob_name_backup
+        self.dedup_ref = dedup_ref
+        self.delta_manifest = delta_manifest
+
+class RestoreResult:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.planned = 0
+        self.current = 0
+        self.restored = 0
+        self.failed = 0
+        self.bytes_restored = 0
+        self.throttle_stats = ThrottleStats()
+
+    def to_dict(self):
+        return {"planned": self.planned, "current": self.current, "restored": self.restored, "failed": self.failed,
+                "bytes_restored": self.bytes_restored, "throttle_retries": self.throttle_stats.retries}
+
+def plan_restore_from_snapshots(client_source, container_name, prefix, timestamp, result, copy_current=False):
+    # One listing pass over blobs and snapshots, per blob the latest version modified at or before the timestamp.
+    # Blobs that were not modified after the timestamp are already in the requested state, they are only
+    # copied (copy_current) when the restore target is another container.
+    plan = []
+    candidate = None
+    blob_name = None
+
+    def close_blob():
+        if candidate is not None:
+            plan.append(candidate)
+
+    for blob in iter_blob_records(client_source.get_container_client(container_name), prefix or None, include_snapshots=True):
+        if blob.name != blob_name:
+            close_blob()
+            blob_name = blob.name
+            candidate = None
+        if blob.last_modified > timestamp:
+            continue
+        if blob.snapshot is None:
+            # current version of the blob already is the version at the timestamp
+            candidate = RestoreItem(blob.name, blob.last_modified, blob.size) if copy_current else None
+            result.current += 1
+            continue
+        if candidate is None or blob.last_modified >= candidate.last_modified:
+            candidate = RestoreItem(blob.name, blob.last_modified, blob.size, snapshot=blob.snapshot)
+    close_blob()
+    return plan
+
+def plan_restore_from_backups(client_backup, container_name, prefix, timestamp):
+    # One listing pass over the backup container, per blob the latest backup version modified at or before the timestamp
+    candidates = {}
+    container_backup = client_backup.get_container_client(container_name + "bak")
+    for blob in iter_blob_records(container_backup, prefix or None, include_metadata=True):
+        parsed = parse_backup_name(blob.name)
+        if parsed is None:
+            continue
+        last_modified = parse_backup_time(parsed[1])
+        if last_modified is None or last_modified > timestamp:
+            continue
+        candidate = candidates.get(parsed[0])
+        if candidate is None or last_modified >= candidate.last_modified:
+            candidates[parsed[0]] = RestoreItem(parsed[0], last_modified, blob.size, blob_name_backup=blob.name,
+                                                dedup_ref=(blob.metadata or {}).get(DEDUP_REF_METADATA), delta_manifest=is_delta_manifest(blob))
+    return list(candidates.values())
+
+def restore_item(client_source, client_backup, container_name, container_name_target, item, result):
+    blob_target = client_source.get_blob_client(container=container_name_target, blob=item.blob_name)
+    if item.blob_name_backup is None:
+        # Restores within the source account read the snapshot (or current blob) using a SAS url as well, copies of large blobs are staged in blocks
+        source_url = get_source_url(client_source, container_name, item.blob_name, item.snapshot)
+        retry_on_throttle(copy_url_to_blob, blob_target, source_url, item.size, stats=result.throttle_stats)
+        return item.size
+
+    container_name_backup = container_name + "bak"
+    blob_name_backup = item.blob_name_backup
+    delta_manifest = item.delta_manifest
+    size = item.size
+    if item.dedup_ref is not None:
+        # Content is stored in the backup the reference points to
+        blob_name_backup = item.dedup_ref
+        properties = client_backup.get_blob_client(container=container_name_backup, blob=blob_name_backup).get_blob_properties()
+        delta_manifest = is_delta_manifest(properties)
+        size = properties.size
+    if delta_manifest:
+        retry_on_throttle(restore_delta_version, client_backup, container_name_backup, blob_name_backup, blob_target, stats=result.throttle_stats)
+        return blob_target.get_blob_properties().size
+    source_url = get_source_url(client_backup, container_name_backup, blob_name_backup)
+    retry_on_throttle(copy_url_to_blob, blob_target, source_url, size, stats=result.throttle_stats)
+    return size
+
+def restore_point_in_time(client_source, client_backup, container_name, prefix, timestamp, from_backup=False, container_name_target=None, dry_run=False):
+    # Restores the blobs under prefix to their version at timestamp, by default in place
+    container_name_target = container_name_target or container_name
+    result = RestoreResult()
+    if from_backup:
+        plan = plan_restore_from_backups(client_backup, container_name, prefix, timestamp)
+    else:
+        plan = plan_restore_from_snapshots(client_source, container_name, prefix, timestamp, result, copy_current=container_name_target != container_name)
+    result.planned = len(plan)
+    logging.info("restore of {}/{} to {}: {} blobs to restore".format(container_name, prefix, timestamp, len(plan)))
+    if dry_run or not plan:
+        return result
+    if container_name_target != container_name:
+        try:
+            client_source.create_container(container_name_target)
+        except ResourceExistsError:
+            pass
+
+    def restore(item):
+        try:
+            size = restore_item(client_source, client_backup, container_name, container_name_target, item, result)
+        except Exception as e:
+            logging.info("restore of blob " + item.blob_name + " failed: " + str(e))
+            with result.lock:
+                result.failed += 1
+            return
+        with result.lock:
+            result.restored += 1
+            result.bytes_restored += size
+            if (result.restored + result.failed) % RESTORE_PROGRESS_INTERVAL == 0:
+                logging.info("restore progress: {} of {} blobs, {} bytes, {} failed".format(result.restored, result.planned, result.bytes_restored, result.failed))
+
+    max_workers = min(len(plan), int(os.environ.get("par_restore_concurrency", DEFAULT_RESTORE_CONCURRENCY)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(bind_context(restore), plan))
+    logging.info("restore finished: {} of {} blobs, {} bytes, {} failed".format(result.restored, result.planned, result.bytes_restored, result.failed))
+    return result
@@ -0,0 +1,223 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from azure.core.exceptions import ResourceNotFoundError
+
+from .backup_index import build_backup_index
+from .backup_naming import normalize_etag, parse_backup_name, parse_timestamp
+from .dedup import DEDUP_INDEX_PREFIX, DEDUP_REF_METADATA, DEDUP_TARGET_METADATA
+from .delta_backup import DELTA_CHUNK_PREFIX, is_delta_manifest, read_delta_manifest
+from .listing import iter_blob_records
+from .metrics import bind_context
+
+# Maximum number of subrequests of a Blob Batch request
+BATCH_DELETE_SIZE = 256
+DEFAULT_BATCH_DELETE_CONCURRENCY = 4
+DEFAULT_RETENTION_KEEP_LAST = 7
+# Chunks are only collected some time after their upload, a delta backup writes its manifest after its chunks
+DEFAULT_CHUNK_GRACE_HOURS = 24
+
+class RetentionPolicy:
+    # A version is kept when it is one of the last keep_last versions, or the latest version of a day, ISO week or month
+    # within the last keep_daily_days days, keep_weekly_weeks weeks or keep_monthly_months months (grandfather-father-son).
+
+    def __init__(self, keep_last=DEFAULT_RETENTION_KEEP_LAST, keep_daily_days=0, keep_weekly_weeks=0, keep_monthly_months=0):
+        # latest version is always kept, the backup of a pending request is copied from it
+        self.keep_last = max(1, keep_last)
+        self.keep_daily_days = keep_daily_days
+        self.keep_weekly_weeks = keep_weekly_weeks
+        self.keep_monthly_months = keep_monthly_months
+
+    @classmethod
+    def from_settings(cls):
+        return cls(int(os.environ.get("par_retention_keep_last", DEFAULT_RETENTION_KEEP_LAST)),
+                   int(os.environ.get("par_retention_keep_daily_days", 0)),
+                   int(os.environ.get("par_retention_keep_weekly_weeks", 0)),
+                   int(os.environ.get("par_retention_keep_monthly_months", 0)))
+
+    def select_expired(self, versions, now):
+        # versions is a list of (timestamp, item), returns the items that are not kept by the policy
+        periods = [
+            (timedelta(days=self.keep_daily_days), lambda timestamp: timestamp.date()),
+            (timedelta(weeks=self.keep_weekly_weeks), lambda timestamp: timestamp.isocalendar()[:2]),
+            (timedelta(days=31 * self.keep_monthly_months), lambda timestamp: (timestamp.year, timestamp.month))
+        ]
+        seen = [set() for _ in periods]
+        expired = []
+        for position, (timestamp, item) in enumerate(sorted(versions, key=lambda version: version[0], reverse=True)):
+            keep = position < self.keep_last
+            for (window, bucket_of), buckets in zip(periods, seen):
+                if now - timestamp >= window:
+                    continue
+                bucket = bucket_of(timestamp)
+                if bucket not in buckets:
+                    # versions are visited newest first, the first version of a bucket is its latest
+                    buckets.add(bucket)
+                    keep = True
+            if not keep:
+                expired.append(item)
+        return expired
+
+class BatchDeleter:
+    # Collects blobs and snapshots to delete in one container, sent as Blob Batch requests of 256 deletes
+
+    def __init__(self, container_client, max_concurrency=None):
+        self.container_client = container_client
+        self.pending = []
+        self.futures = []
+        self.deleted = 0
+        self.failed = 0
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency or int(os.environ.get("par_retention_batch_concurrency", DEFAULT_BATCH_DELETE_CONCURRENCY)))
+
+    def delete(self, blob_name, snapshot=None):
+        self.pending.append({"name": blob_name, "snapshot": snapshot})
+        if len(self.pending) >= BATCH_DELETE_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.futures.append(self.executor.submit(bind_context(self._send), self.pending))
+            self.pending = []
+
+    def _send(self, batch):
+        responses = self.container_client.delete_blobs(*batch, raise_on_any_failure=False)
+        return sum(1 for response in responses if response.status_code == 202), len(batch)
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown(wait=True)
+        for future in self.futures:
+            if future.exception() is not None:
+                logging.info("batch delete in container {} failed: {}".format(self.container_client.container_name, future.exception()))
+                continue
+            deleted, sent = future.result()
+            self.deleted += deleted
+            self.failed += sent - deleted
+        self.futures = []
+
+def parse_snapshot_time(snapshot):
+    # Snapshot ids are timestamps with 7 fractional digits, e.g. 2020-06-01T10:11:12.1234567Z
+    return datetime.strptime(snapshot[:19], "%Y-%m-%dT%H:%M:%S").replace(tzinfo=timezone.utc)
+
+def parse_backup_time(modified):
+    # Backup names contain str() of the last modified datetime of the source, e.g. 2020-06-01 10:11:12+00:00
+    return parse_timestamp(modified)
+
+def prune_snapshots(client_source, client_backup, container_name, policy, now):
+    # Deletes expired snapshots of the container, only snapshots of versions that are in backup are deleted
+    container_source = client_source.get_container_client(container_name)
+    deleter = BatchDeleter(container_source)
+    backup_index = None
+
+    def prune_blob(blob_name, snapshots):
+        nonlocal backup_index
+        expired = policy.select_expired([(parse_snapshot_time(snapshot.snapshot), snapshot) for snapshot in snapshots], now)
+        if not expired:
+            return
+        if backup_index is None:
+            backup_index = build_backup_index(client_backup, container_name + "bak")
+        for snapshot in expired:
+            # snapshot has the etag of the blob at snapshot time
+            if backup_index.contains(blob_name, normalize_etag(snapshot.etag)):
+                deleter.delete(blob_name, snapshot.snapshot)
+
+    # Snapshots of a blob are listed together, just before the blob itself
+    blob_name = None
+    snapshots = []
+    for blob in iter_blob_records(container_source, include_snapshots=True):
+        if blob.name != blob_name:
+            if snapshots:
+                prune_blob(blob_name, snapshots)
+            blob_name = blob.name
+            snapshots = []
+        if blob.snapshot is not None:
+            snapshots.append(blob)
+    if snapshots:
+        prune_blob(blob_name, snapshots)
+
+    deleter.close()
+    logging.info("{} snapshots deleted in container {}, {} failed".format(deleter.deleted, container_name, deleter.failed))
+    return deleter.deleted
+
+def prune_backups(client_backup, container_name_backup, policy, now):
+    # Deletes expired backup versions. Backups referred to by a dedup reference are kept, chunks of delta
+    # backups are collected when no remaining manifest uses them.
+    # An expired backup that is the target of a content index marker can still get new references while this run
+    # lists the container. Its marker is deleted first, the backup is deleted by a later run that lists all references.
+    container_backup = client_backup.get_container_client(container_name_backup)
+    versions = {}
+    markers = {}
+    try:
+        for blob in iter_blob_records(container_backup, include_metadata=True):
+            if blob.name.startswith(DEDUP_INDEX_PREFIX):
+                target = (blob.metadata or {}).get(DEDUP_TARGET_METADATA)
+                if target is not None:
+                    markers[target] = blob.name
+                continue
+            parsed = parse_backup_name(blob.name)
+            if parsed is None:
+                continue
+            timestamp = parse_backup_time(parsed[1])
+            if timestamp is None:
+                continue
+            versions.setdefault(parsed[0], []).append((timestamp, (blob.name, (blob.metadata or {}).get(DEDUP_REF_METADATA), is_delta_manifest(blob))))
+    except ResourceNotFoundError:
+        return 0
+
+    expired = []
+    for blob_versions in versions.values():
+        expired.extend(policy.select_expired(blob_versions, now))
+    if not expired:
+        return 0
+
+    expired_names = set(name for name, _, _ in expired)
+    referenced = set(ref for blob_versions in versions.values() for _, (name, ref, _) in blob_versions if ref and name not in expired_names)
+    retired = set(name for name in expired_names if name in markers and name not in referenced)
+    kept = referenced | retired
+    deleter = BatchDeleter(container_backup)
+    manifests_deleted = 0
+    for name, _, is_manifest in expired:
+        if name in retired:
+            # new references can no longer find this backup, it is deleted by the next run when it has none
+            deleter.delete(markers[name])
+            continue
+        if name in kept:
+            continue
+        deleter.delete(name)
+        manifests_deleted += is_manifest
+    deleter.close()
+    logging.info("{} backups deleted in container {}, {} failed, {} retired from the content index".format(deleter.deleted - len(retired), container_name_backup, deleter.failed, len(retired)))
+
+    if manifests_deleted:
+        remaining_manifests = [name for blob_versions in versions.values() for _, (name, _, is_manifest) in blob_versions
+                               if is_manifest and (name not in expired_names or name in kept)]
+        collect_chunks(container_backup, remaining_manifests, now)
+    return deleter.deleted - len(retired)
+
+def collect_chunks(container_backup, manifests, now):
+    # Deletes chunks not used by any remaining manifest and older than the grace period
+    live_chunks = set()
+    for name in manifests:
+        live_chunks.update(read_delta_manifest(container_backup.get_blob_client(name))["chunks"])
+    grace = timedelta(hours=int(os.environ.get("par_retention_chunk_grace_hours", DEFAULT_CHUNK_GRACE_HOURS)))
+
+    deleter = BatchDeleter(container_backup)
+    for chunk in iter_blob_records(container_backup, DELTA_CHUNK_PREFIX):
+        if chunk.name[len(DELTA_CHUNK_PREFIX):] not in live_chunks and now - chunk.last_modified > grace:
+            deleter.delete(chunk.name)
+    deleter.close()
+    logging.info("{} unused chunks deleted in container {}".format(deleter.deleted, container_backup.container_name))
+
+def apply_retention(client_source, client_backup, prune_backup_containers=True):
+    # Applies the retention policy to the snapshots of all source containers and to their backup containers
+    policy = RetentionPolicy.from_settings()
+    now = datetime.now(timezone.utc)
+    result = {"containers": 0, "snapshots_deleted": 0, "backups_deleted": 0}
+    for container in client_source.list_containers():
+        result["containers"] += 1
+        result["snapshots_deleted"] += prune_snapshots(client_source, client_backup, container.name, policy, now)
+        if prune_backup_containers:
+            result["backups_deleted"] += prune_backups(client_backup, container.name + "bak", policy, now)
+    return result
@@ -0,0 +1,142 @@
+import json
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from azure.core.exceptions import ResourceExistsError
+from azure.storage.blob import BlobPrefix
+
+from .backup_queue import BackupRequestQueue, get_queue_client, DEFAULT_MAX_CONCURRENCY_QUEUE
+from .checkpoint import ContainerCheckpoint
+from .metrics import bind_context
+from .properties_cache import BlobPropertiesCache
+from .reconcile import reconcile_container
+
+# Queue of partition messages, see QueueReconcilePartition/function.json
+PARTITION_QUEUE_NAME = "queuereconcilepartitions"
+# State store names of a sharded run and of the results of its partitions
+SHARD_RUN_PREFIX = "_shards_"
+# A worker stops listing before the function timeout (default 5 minutes on consumption plan), saves the listing
+# position of the partition and enqueues a message to continue the partition
+DEFAULT_PARTITION_TIME_BUDGET_SECONDS = 240
+# Messages are moved to the poison queue after this many attempts (host.json extensions.queues.maxDequeueCount)
+MAX_DEQUEUE_COUNT = 5
+
+def list_partitions(client_source):
+    # A partition is a top-level folder of a container, blobs directly in a container form a partition of their own.
+    # Only the first level of each container is listed by the coordinator.
+    for container in client_source.list_containers():
+        has_root_blobs = False
+        for item in client_source.get_container_client(container.name).walk_blobs(delimiter="/"):
+            if isinstance(item, BlobPrefix):
+                yield {"c": container.name, "p": item.name, "r": False}
+            else:
+                has_root_blobs = True
+        if has_root_blobs:
+            yield {"c": container.name, "p": None, "r": True}
+
+def get_result_name(run_id, index):
+    return "{}{}_{}".format(SHARD_RUN_PREFIX, run_id, index)
+
+def get_checkpoint_name(run_id, index):
+    return get_result_name(run_id, index) + "_checkpoint"
+
+def start_sharded_run(client_source, checkpoint_store):
+    # Enqueues one message per partition, queue-triggered workers reconcile the partitions and store their results
+    run_id = uuid.uuid4().hex
+    partitions = list(list_partitions(client_source))
+    checkpoint_store.save(SHARD_RUN_PREFIX + run_id, json.dumps({
+        "run": run_id, "started": datetime.now(timezone.utc).isoformat(), "partitions": len(partitions)}))
+
+    queue_client = get_queue_client(PARTITION_QUEUE_NAME)
+    try:
+        queue_client.create_queue()
+    except ResourceExistsError:
+        pass
+    messages = [json.dumps(dict(partition, run=run_id, i=index), separators=(',', ':')) for index, partition in enumerate(partitions)]
+    with ThreadPoolExecutor(max_workers=int(os.environ.get("par_max_concurrency_queue", DEFAULT_MAX_CONCURRENCY_QUEUE))) as executor:
+        list(executor.map(bind_context(queue_client.send_message), messages))
+    logging.info("sharded run {} started with {} partitions".format(run_id, len(partitions)))
+    return run_id, len(partitions)
+
+def reconcile_partition(client_source, client_backup, checkpoint_store, partition, dequeue_count=1):
+    # Reconciles one partition and stores its result for the coordinator. A partition that is not listed completely
+    # within the time budget is continued by a new message, the last attempt of a failing partition stores a failed result.
+    result_name = get_result_name(partition["run"], partition["i"])
+    last_attempt = (dequeue_count or 1) >= MAX_DEQUEUE_COUNT
+    if last_attempt:
+        # stays in place when the function times out, the message then goes to the poison queue
+        save_failed_result(checkpoint_store, result_name, partition, "no result after {} attempts".format(MAX_DEQUEUE_COUNT))
+    try:
+        return reconcile_partition_slice(client_source, client_backup, checkpoint_store, partition, result_name, last_attempt)
+    except Exception as e:
+        if last_attempt:
+            save_failed_result(checkpoint_store, result_name, partition, str(e))
+        raise
+
+def reconcile_partition_slice(client_source, client_backup, checkpoint_store, partition, result_name, replace_result=False):
+    # The listing position of the partition is kept in a checkpoint of its own, stored under the name of the partition
+    checkpoint_name = get_checkpoint_name(partition["run"], partition["i"])
+    checkpoint = ContainerCheckpoint(checkpoint_name, checkpoint_store.load(checkpoint_name))
+    deadline = time.time() + int(os.environ.get("par_reconcile_time_budget_seconds", DEFAULT_PARTITION_TIME_BUDGET_SECONDS))
+
+    backup_queue = BackupRequestQueue(get_queue_client())
+    properties_cache = BlobPropertiesCache()
+    try:
+        completed = reconcile_container(client_source, client_backup, backup_queue, partition["c"], properties_cache, True, checkpoint, checkpoint_store, deadline,
+                                        prefix=partition["p"], root_only=partition["r"])
+    finally:
+        backup_queue.close()
+    # counts of earlier slices of the partition are carried in the message
+    backup_requests = partition.get("b", 0) + backup_queue.requests_added
+    queue_messages = partition.get("m", 0) + backup_queue.messages_sent
+
+    if not completed:
+        continuation = dict(partition, b=backup_requests, m=queue_messages, n=partition.get("n", 0) + 1)
+        result = {"container": partition["c"], "prefix": partition["p"], "status": "continued", "slice": continuation["n"]}
+        if replace_result:
+            # replaces the failed result of the last attempt before the next slice can store its own result
+            checkpoint_store.save(result_name, json.dumps(result))
+        get_queue_client(PARTITION_QUEUE_NAME).send_message(json.dumps(continuation, separators=(',', ':')))
+        logging.info("partition {}/{} continued in slice {}".format(partition["c"], partition["p"], continuation["n"]))
+        return result
+
+    result = {"container": partition["c"], "prefix": partition["p"], "status": "ok", "backup_requests": backup_requests,
+              "queue_messages": queue_messages, "slices": partition.get("n", 0) + 1, "finished": datetime.now(timezone.utc).isoformat()}
+    checkpoint_store.save(result_name, json.dumps(result))
+    return result
+
+def save_failed_result(checkpoint_store, result_name, partition, error):
+    checkpoint_store.save(result_name, json.dumps({"container": partition["c"], "prefix": partition["p"], "status": "failed", "error": error,
+                                                   "backup_requests": partition.get("b", 0), "queue_messages": partition.get("m", 0),
+                                                   "finished": datetime.now(timezone.utc).isoformat()}))
+
+def aggregate_sharded_run(checkpoint_store, run_id):
+    # Sums the results of the partitions that finished so far. A partition that failed its last attempt is reported
+    # as failed, a partition without result or with a continued result is still running. The run is finished when
+    # every partition finished or failed.
+    run_state = checkpoint_store.load(SHARD_RUN_PREFIX + run_id)
+    if run_state is None:
+        return None
+    with ThreadPoolExecutor(max_workers=int(os.environ.get("par_max_concurrency_queue", DEFAULT_MAX_CONCURRENCY_QUEUE))) as executor:
+        results = [result for result in executor.map(bind_context(checkpoint_store.load), [get_result_name(run_id, index) for index in range(run_state["partitions"])])
+                   if result is not None and result.get("status") != "continued"]
+    failed = [result for result in results if result.get("status") == "failed"]
+    if len(results) < run_state["partitions"]:
+        status = "running"
+    else:
+        status = "failed" if failed else "ok"
+    return {
+        "status": status,
+        "run_id": run_id,
+        "started": run_state["started"],
+        "partitions": run_state["partitions"],
+        "partitions_finished": len(results) - len(failed),
+        "partitions_failed": len(failed),
+        "failed_partitions": [{"container": result["container"], "prefix": result["prefix"], "error": result["error"]} for result in failed],
+        "backup_requests": sum(result["backup_requests"] for result in results),
+        "queue_messages": sum(result["queue_messages"] for result in results)
+    }
@@ -0,0 +1,84 @@
+import base64
+import hashlib
+import json
+import logging
+import zlib
+from array import array
+from bisect import bisect_left
+
+# State store name of the index of a container, container names cannot start with "_"
+SNAPSHOT_INDEX_PREFIX = "_snapshots_"
+
+def snapshot_index_name(container_name, prefix="", recursive=True):
+    # One index per listed prefix, so runs for one folder only load and rewrite the index of that folder and
+    # producers of different folders of a container do not overwrite each other's index
+    if not prefix and recursive:
+        return SNAPSHOT_INDEX_PREFIX + container_name
+    shard = hashlib.sha1((prefix + ("" if recursive else "\n")).encode("utf-8")).hexdigest()[:16]
+    return SNAPSHOT_INDEX_PREFIX + container_name + "_" + shard
+
+def value_key(value):
+    # 64 bit key of a blob name or etag, a collision only causes a changed blob to be snapshotted in a later run
+    return int.from_bytes(hashlib.sha1(value.encode("utf-8")).digest()[:8], "big")
+
+def encode_keys(keys):
+    return base64.b64encode(zlib.compress(array("Q", keys).tobytes())).decode("ascii")
+
+def decode_keys(encoded):
+    keys = array("Q")
+    if encoded:
+        keys.frombytes(zlib.decompress(base64.b64decode(encoded)))
+    return keys
+
+class SnapshotIndex:
+    # ETag of the last snapshot the producer created per blob of a prefix, stored as two parallel
+    # arrays of 64 bit keys sorted on blob name. Updates of a run are merged into the arrays on save.
+    # An index that was not loaded from the store is bootstrapped by a listing that includes snapshots.
+
+    def __init__(self, container_name, prefix="", recursive=True, state=None):
+        self.container_name = container_name
+        self.prefix = prefix
+        self.recursive = recursive
+        self.loaded = state is not None
+        state = state or {}
+        self.names = decode_keys(state.get("names"))
+        self.etags = decode_keys(state.get("etags"))
+        self.updates = {}
+
+    def get(self, blob_name):
+        # Key of the last snapshotted etag, or None when the blob is not in the index
+        key = value_key(blob_name)
+        if key in self.updates:
+            return self.updates[key]
+        position = bisect_left(self.names, key)
+        if position < len(self.names) and self.names[position] == key:
+            return self.etags[position]
+        return None
+
+    def is_snapshotted(self, blob_name, etag):
+        return self.get(blob_name) == value_key(etag)
+
+    def set(self, blob_name, etag):
+        self.updates[value_key(blob_name)] = value_key(etag)
+
+    def to_json(self):
+        merged = dict(zip(self.names, self.etags))
+        merged.update(self.updates)
+        names = sorted(merged)
+        return json.dumps({
+            "container": self.container_name,
+            "prefix": self.prefix,
+            "recursive": self.recursive,
+            "names": encode_keys(names),
+            "etags": encode_keys([merged[key] for key in names])
+        })
+
+def load_snapshot_index(store, container_name, prefix="", recursive=True):
+    return SnapshotIndex(container_name, prefix, recursive, store.load(snapshot_index_name(container_name, prefix, recursive)))
+
+def save_snapshot_index(store, index):
+    # A bootstrapped index is saved even when empty, the next run does not bootstrap again
+    if not index.updates and index.loaded:
+        return
+    store.save(snapshot_index_name(index.container_name, index.prefix, index.recursive), index.to_json())
+    logging.info("snapshot index saved for container {} prefix {}, {} updated blobs".format(index.container_name, index.prefix, len(index.updates)))
@@ -0,0 +1,54 @@
+import asyncio
+import logging
+import random
+import time
+
+from azure.core.exceptions import HttpResponseError
+
+MAX_THROTTLE_RETRIES = 6
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 30
+
+# Storage signals throttling with 503 ServerBusy, timeouts under load with 500 OperationTimedOut
+THROTTLE_ERROR_CODES = ("ServerBusy", "OperationTimedOut")
+
+def is_throttled(error):
+    if not isinstance(error, HttpResponseError):
+        return False
+    return error.status_code == 503 or getattr(error, "error_code", None) in THROTTLE_ERROR_CODES
+
+def backoff_seconds(attempt):
+    # exponential backoff with full jitter
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+class ThrottleStats:
+    def __init__(self):
+        self.retries = 0
+
+def retry_on_throttle(operation, *args, stats=None, **kwargs):
+    attempt = 0
+    while True:
+        try:
+            return operation(*args, **kwargs)
+        except HttpResponseError as error:
+            if not is_throttled(error) or attempt >= MAX_THROTTLE_RETRIES:
+                raise
+            if stats is not None:
+                stats.retries += 1
+            logging.info("storage busy, retry {} of {}".format(attempt + 1, MAX_THROTTLE_RETRIES))
+            time.sleep(backoff_seconds(attempt))
+            attempt += 1
+
+async def retry_on_throttle_async(operation, *args, stats=None, **kwargs):
+    attempt = 0
+    while True:
+        try:
+            return await operation(*args, **kwargs)
+        except HttpResponseError as error:
+            if not is_throttled(error) or attempt >= MAX_THROTTLE_RETRIES:
+                raise
+            if stats is not None:
+                stats.retries += 1
+            logging.info("storage busy, retry {} of {}".format(attempt + 1, MAX_THROTTLE_RETRIES))
+            await asyncio.sleep(backoff_seconds(attempt))
+            attempt += 1
@@ -0,0 +1,158 @@
+import importlib
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+import types
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("azure.functions")
+pytest.importorskip("azure.storage.blob")
+pytest.importorskip("azure.storage.queue")
+
+import azure.functions as func
+
+from fake_storage import FakeBlobServiceClient, FakeQueueClient, FakeStorageRegistry, StubAdfSession
+
+# Functions import shared code relatively, register the function app folder as package __app__ like the Functions host does
+APP_DIR = Path(__file__).resolve().parents[2] / "blog-snapshots-func"
+if "__app__" not in sys.modules:
+    app_package = types.ModuleType("__app__")
+    app_package.__path__ = [str(APP_DIR)]
+    sys.modules["__app__"] = app_package
+
+SOURCE_ACCOUNT = "benchsource"
+BACKUP_ACCOUNT = "benchbackup"
+QUEUE_ACCOUNT = "benchqueue"
+QUEUE_NAME = "queuesnapshotmetadata"
+
+# Size of the synthetic datalake, override with environment variables for larger runs
+BENCHMARK_CONTAINERS = int(os.environ.get("BENCHMARK_CONTAINERS", 2))
+BENCHMARK_BLOBS = int(os.environ.get("BENCHMARK_BLOBS", 2000))
+BENCHMARK_FOLDERS = int(os.environ.get("BENCHMARK_FOLDERS", 10))
+BENCHMARK_SNAPSHOT_DEPTH = int(os.environ.get("BENCHMARK_SNAPSHOT_DEPTH", 2))
+BENCHMARK_CHANGE_RATIO = float(os.environ.get("BENCHMARK_CHANGE_RATIO", 0.1))
+BENCHMARK_BLOB_BYTES = int(os.environ.get("BENCHMARK_BLOB_BYTES", 1024))
+
+_results = []
+
+def app_module(name):
+    return importlib.import_module("__app__." + name)
+
+def call_json(main, params):
+    # Calls an HTTP-triggered function with query parameters and returns its JSON result
+    response = main(func.HttpRequest(method="GET", url="/api/benchmark", params=params, body=b""))
+    assert response.status_code == 200
+    return json.loads(response.get_body())
+
+class FakeStorage:
+    # Fake accounts, queues and ADFv2 endpoint wired into the module level client caches of the functions
+
+    def __init__(self, monkeypatch):
+        self.registry = FakeStorageRegistry()
+        self.stats = self.registry.stats
+        self.source = FakeBlobServiceClient(SOURCE_ACCOUNT, self.registry)
+        self.backup = FakeBlobServiceClient(BACKUP_ACCOUNT, self.registry)
+        self.queue_account = FakeBlobServiceClient(QUEUE_ACCOUNT, self.registry)
+        self.adf = StubAdfSession(self.stats)
+
+        sharding = app_module("shared_code.sharding")
+        self.queues = {QUEUE_NAME: FakeQueueClient(QUEUE_NAME, self.stats),
+                       sharding.PARTITION_QUEUE_NAME: FakeQueueClient(sharding.PARTITION_QUEUE_NAME, self.stats)}
+
+        for name, value in {
+            "par_storage_account_name_source": SOURCE_ACCOUNT,
+            "par_storage_account_name_backup": BACKUP_ACCOUNT,
+            "par_storage_account_name_queue": QUEUE_ACCOUNT,
+            "par_storage_account_key_queue": "key",
+            "par_queue_name": QUEUE_NAME,
+            "par_checkpoint_store": "blob",
+            "par_subscription_id": "subscription",
+            "par_resource_group_name": "resourcegroup",
+            "par_adfv2_name": "factory",
+            "par_adfv2_pipeline_name": "blogtriggerbackup",
+            "par_adfv2_batch_pipeline_name": "blogtriggerbackupbatch",
+            "MSI_ENDPOINT": "http://localhost/msi/token",
+            "MSI_SECRET": "secret"
+        }.items():
+            monkeypatch.setenv(name, value)
+
+        # module level caches are replaced, every benchmark starts cold
+        clients = app_module("shared_code.clients")
+        monkeypatch.setattr(clients, "_credential", object())
+        monkeypatch.setattr(clients, "_blob_service_clients", {SOURCE_ACCOUNT: self.source, BACKUP_ACCOUNT: self.backup, QUEUE_ACCOUNT: self.queue_account})
+        monkeypatch.setattr(app_module("shared_code.backup_queue"), "_queue_clients", dict(self.queues))
+        adf_client = app_module("shared_code.adf_client")
+        monkeypatch.setattr(adf_client, "_session", self.adf)
+        monkeypatch.setattr(adf_client, "_token_cache", {})
+        monkeypatch.setattr(app_module("shared_code.direct_copy"), "_user_delegation_keys", {})
+        monkeypatch.setattr(app_module("QueueCreateBlobBackupADFv2"), "_backup_containers", set())
+        monkeypatch.setattr(app_module("shared_code.copy_tracker"), "_tracking_containers", set())
+
+    def build_datalake(self, containers=BENCHMARK_CONTAINERS, blobs=BENCHMARK_BLOBS, folders=BENCHMARK_FOLDERS,
+                       snapshot_depth=BENCHMARK_SNAPSHOT_DEPTH, change_ratio=BENCHMARK_CHANGE_RATIO, blob_bytes=BENCHMARK_BLOB_BYTES, seed=1):
+        # Blobs with snapshot_depth snapshots and a backup of the latest snapshot. A change_ratio fraction of the
+        # blobs was modified after its latest snapshot (new version without snapshot and backup).
+        naming = app_module("shared_code.backup_naming")
+        rng = random.Random(seed)
+        changed = {}
+        for container_index in range(containers):
+            container_name = "container{}".format(container_index)
+            self.source.create_container(container_name)
+            self.backup.create_container(container_name + "bak")
+            changed[container_name] = 0
+            for blob_index in range(blobs):
+                blob_name = "folder{}/file{}.csv".format(blob_index % folders, blob_index)
+                for version in range(max(snapshot_depth, 1)):
+                    blob = self.source.put(container_name, blob_name, rng.randbytes(blob_bytes))
+                    if snapshot_depth:
+                        container = self.source.containers[container_name]
+                        container["snapshots"].setdefault(blob_name, []).append(blob.snapshot_copy(self.source.next_snapshot_id()))
+                self.backup.put(container_name + "bak", naming.append_timestamp_etag(blob_name, blob.last_modified, naming.normalize_etag(blob.etag)), blob.data)
+                if rng.random() < change_ratio:
+                    self.source.put(container_name, blob_name, rng.randbytes(blob_bytes))
+                    changed[container_name] += 1
+        self.stats.reset()
+        return changed
+
+@pytest.fixture
+def storage(monkeypatch):
+    return FakeStorage(monkeypatch)
+
+@pytest.fixture
+def benchmark(storage):
+    # benchmark(scenario, function, *args) runs the function and records requests, wall time and peak memory
+    def run(scenario, function, *args, **kwargs):
+        storage.stats.reset()
+        tracemalloc.start()
+        started = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            wall_time = time.perf_counter() - started
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        _results.append({
+            "scenario": scenario,
+            "requests": storage.stats.total(),
+            "requests_by_operation": dict(storage.stats.requests),
+            "wall_time_seconds": round(wall_time, 3),
+            "peak_memory_bytes": peak_memory
+        })
+        return result
+    return run
+
+def pytest_terminal_summary(terminalreporter):
+    if not _results:
+        return
+    terminalreporter.section("backup function benchmarks")
+    terminalreporter.write_line("{:<40} {:>10} {:>10} {:>14}".format("scenario", "requests", "seconds", "peak memory"))
+    for result in _results:
+        terminalreporter.write_line("{:<40} {:>10} {:>10.3f} {:>14,}".format(result["scenario"], result["requests"], result["wall_time_seconds"], result["peak_memory_bytes"]))
+    if os.environ.get("BENCHMARK_JSON"):
+        with open(os.environ["BENCHMARK_JSON"], "w") as report_file:
+            json.dump(_results, report_file, indent=2)
@@ -0,0 +1,471 @@
+import base64
+import hashlib
+import itertools
+import json
+import threading
+from bisect import bisect_right
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qs, quote, unquote, urlparse
+
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+from azure.storage.blob import BlobPrefix, UserDelegationKey
+
+# In-process fake of the blob and queue storage accounts used by the functions. It implements the subset of
+# azure-storage-blob and azure-storage-queue the functions call, and counts every request by operation.
+
+class RequestStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = Counter()
+
+    def count(self, operation):
+        with self.lock:
+            self.requests[operation] += 1
+
+    def total(self):
+        return sum(self.requests.values())
+
+    def reset(self):
+        with self.lock:
+            self.requests.clear()
+
+class FakeContentSettings:
+    def __init__(self, content_md5=None, content_type=None):
+        self.content_md5 = content_md5
+        self.content_type = content_type
+
+class FakeBlob:
+    # Stored version of a blob or snapshot, also returned as its properties
+    _etags = itertools.count(0x8D800000000000)
+    _etags_lock = threading.Lock()
+
+    def __init__(self, container, name, data, last_modified, metadata=None, content_md5=None, snapshot=None):
+        self.container = container
+        self.name = name
+        self.data = data
+        self.last_modified = last_modified
+        self.metadata = metadata or {}
+        self.content_settings = FakeContentSettings(content_md5)
+        self.snapshot = snapshot
+        with FakeBlob._etags_lock:
+            self.etag = "\"0x{:X}\"".format(next(FakeBlob._etags))
+
+    @property
+    def size(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def snapshot_copy(self, snapshot):
+        copy = FakeBlob(self.container, self.name, self.data, self.last_modified, dict(self.metadata), self.content_settings.content_md5, snapshot)
+        copy.etag = self.etag
+        return copy
+
+class FakeContainerItem:
+    def __init__(self, name):
+        self.name = name
+
+class FakeBlobPrefix(BlobPrefix):
+    def __init__(self, name, container):
+        # pylint: disable=super-init-not-called
+        self.name = name
+        self.prefix = name
+        self.container = container
+
+class FakePageIterator:
+    def __init__(self, fetch_page, continuation_token):
+        self.fetch_page = fetch_page
+        self.continuation_token = continuation_token
+        self.started = False
+
+    def __iter__(self):
+        while not self.started or self.continuation_token:
+            self.started = True
+            page, self.continuation_token = self.fetch_page(self.continuation_token)
+            yield iter(page)
+
+class FakeItemPaged:
+    def __init__(self, fetch_page):
+        self.fetch_page = fetch_page
+
+    def by_page(self, continuation_token=None):
+        return FakePageIterator(self.fetch_page, continuation_token)
+
+    def __iter__(self):
+        for page in self.by_page():
+            yield from page
+
+class FakeDownloader:
+    def __init__(self, data):
+        self.data = data
+
+    def readall(self):
+        return self.data
+
+    def chunks(self):
+        for offset in range(0, max(len(self.data), 1), 4 * 1024 * 1024):
+            yield self.data[offset:offset + 4 * 1024 * 1024]
+
+class FakeBlobClient:
+    def __init__(self, account, container_name, blob_name, snapshot=None):
+        self.account = account
+        self.container_name = container_name
+        self.blob_name = blob_name
+        self.snapshot = snapshot
+
+    @property
+    def url(self):
+        url = "https://{}.blob.core.windows.net/{}/{}".format(self.account.name, self.container_name, quote(self.blob_name))
+        return url + ("?snapshot=" + self.snapshot if self.snapshot else "")
+
+    def _container(self):
+        return self.account.get_container(self.container_name)
+
+    def get_blob_properties(self, **kwargs):
+        self.account.stats.count("get_blob_properties")
+        return self.account.get_version(self.container_name, self.blob_name, self.snapshot)
+
+    def download_blob(self, offset=None, length=None, **kwargs):
+        self.account.stats.count("get_blob")
+        data = self.account.get_version(self.container_name, self.blob_name, self.snapshot).data
+        if offset is not None:
+            data = data[offset:offset + length if length is not None else None]
+        return FakeDownloader(data)
+
+    def create_snapshot(self, metadata=None, etag=None, match_condition=None, **kwargs):
+        self.account.stats.count("snapshot_blob")
+        container = self._container()
+        with self.account.lock:
+            blob = container["blobs"].get(self.blob_name)
+            if blob is None:
+                raise ResourceNotFoundError("blob not found")
+            if etag is not None and etag.replace("\"", "") != blob.etag.replace("\"", ""):
+                raise ResourceModifiedError("condition not met")
+            snapshot = self.account.next_snapshot_id()
+            container["snapshots"].setdefault(self.blob_name, []).append(blob.snapshot_copy(snapshot))
+        return {"snapshot": snapshot, "etag": blob.etag}
+
+    def upload_blob(self, data, overwrite=False, metadata=None, content_settings=None, **kwargs):
+        self.account.stats.count("put_blob")
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        content_md5 = content_settings.content_md5 if content_settings is not None else None
+        self.account.put(self.container_name, self.blob_name, bytes(data), overwrite, metadata, content_md5)
+
+    def start_copy_from_url(self, source_url, requires_sync=None, source_etag=None, source_match_condition=None, **kwargs):
+        self.account.stats.count("copy_blob_from_url")
+        source = self.account.registry.resolve(source_url)
+        if source_etag is not None and source_etag.replace("\"", "") != source.etag.replace("\"", ""):
+            raise ResourceModifiedError("source condition not met")
+        self.account.put(self.container_name, self.blob_name, source.data, True, dict(source.metadata), source.content_settings.content_md5)
+        return {"copy_status": "success"}
+
+    def stage_block_from_url(self, block_id, source_url, source_offset=None, source_length=None, **kwargs):
+        self.account.stats.count("put_block_from_url")
+        data = self.account.registry.resolve(source_url).data
+        if source_offset is not None:
+            data = data[source_offset:source_offset + source_length]
+        with self.account.lock:
+            self.account.staged_blocks.setdefault((self.container_name, self.blob_name), {})[block_id] = data
+
+    def commit_block_list(self, block_list, **kwargs):
+        self.account.stats.count("put_block_list")
+        with self.account.lock:
+            staged = self.account.staged_blocks.pop((self.container_name, self.blob_name), {})
+        self.account.put(self.container_name, self.blob_name, b"".join(staged[block.id] for block in block_list), True)
+
+    def delete_blob(self, **kwargs):
+        self.account.stats.count("delete_blob")
+        self.account.delete(self.container_name, self.blob_name, self.snapshot)
+
+class FakeContainerClient:
+    def __init__(self, account, container_name):
+        self.account = account
+        self.container_name = container_name
+
+    def create_container(self, **kwargs):
+        self.account.create_container(self.container_name)
+
+    def get_blob_client(self, blob, snapshot=None):
+        return FakeBlobClient(self.account, self.container_name, blob, snapshot)
+
+    def _listing(self, name_starts_with, include):
+        # Snapshots are listed just before their blob, oldest first
+        container = self.account.get_container(self.container_name)
+        with self.account.lock:
+            names = sorted(name for name in set(container["blobs"]) | set(container["snapshots"]) if name.startswith(name_starts_with or ""))
+            items = []
+            for name in names:
+                if include and "snapshots" in include:
+                    items.extend(container["snapshots"].get(name, []))
+                if name in container["blobs"]:
+                    items.append(container["blobs"][name])
+        return items
+
+    def _paged(self, items, results_per_page):
+        # Like the service marker, the continuation token is the position after the last listed name, so a listing
+        # resumed by a later invocation is not shifted by snapshots created in the meantime
+        page_size = results_per_page or 5000
+        keys = [listing_key(item) for item in items]
+
+        def fetch_page(continuation_token):
+            self.account.stats.count("list_blobs")
+            start = bisect_right(keys, tuple(json.loads(continuation_token))) if continuation_token else 0
+            end = start + page_size
+            return items[start:end], (json.dumps(keys[end - 1]) if end < len(items) else None)
+        return FakeItemPaged(fetch_page)
+
+    def list_blobs(self, name_starts_with=None, include=None, results_per_page=None, **kwargs):
+        return self._paged(self._listing(name_starts_with, include), results_per_page)
+
+    def walk_blobs(self, name_starts_with=None, include=None, delimiter="/", results_per_page=None, **kwargs):
+        # Blobs directly under the prefix and one BlobPrefix per folder
+        prefix = name_starts_with or ""
+        items = []
+        folders = set()
+        for item in self._listing(prefix, include):
+            rest = item.name[len(prefix):]
+            if delimiter in rest:
+                folder = prefix + rest[:rest.index(delimiter) + 1]
+                if folder not in folders:
+                    folders.add(folder)
+                    items.append(FakeBlobPrefix(folder, self.container_name))
+            else:
+                items.append(item)
+        return self._paged(items, results_per_page)
+
+    def delete_blobs(self, *blobs, raise_on_any_failure=True, **kwargs):
+        self.account.stats.count("blob_batch")
+        responses = []
+        for blob in blobs:
+            name = blob if isinstance(blob, str) else blob["name"]
+            snapshot = None if isinstance(blob, str) else blob.get("snapshot")
+            try:
+                self.account.delete(self.container_name, name, snapshot)
+                responses.append(FakeResponse(202))
+            except ResourceNotFoundError:
+                responses.append(FakeResponse(404))
+        return iter(responses)
+
+class FakeBlobServiceClient:
+    # One storage account
+
+    def __init__(self, name, registry):
+        self.name = name
+        self.account_name = name
+        self.registry = registry
+        self.stats = registry.stats
+        self.lock = threading.Lock()
+        self.containers = {}
+        self.staged_blocks = {}
+        self.snapshot_clock = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        self.url = "https://{}.blob.core.windows.net".format(name)
+        registry.accounts[name] = self
+
+    def next_snapshot_id(self):
+        self.snapshot_clock += timedelta(milliseconds=1)
+        return self.snapshot_clock.strftime("%Y-%m-%dT%H:%M:%S.%f") + "0Z"
+
+    def create_container(self, name, **kwargs):
+        self.stats.count("create_container")
+        with self.lock:
+            if name in self.containers:
+                raise ResourceExistsError("container exists")
+            self.containers[name] = {"blobs": {}, "snapshots": {}}
+
+    def get_container(self, name):
+        container = self.containers.get(name)
+        if container is None:
+            raise ResourceNotFoundError("container not found")
+        return container
+
+    def list_containers(self, **kwargs):
+        self.stats.count("list_containers")
+        return iter([FakeContainerItem(name) for name in sorted(self.containers)])
+
+    def get_container_client(self, container):
+        return FakeContainerClient(self, container)
+
+    def get_blob_client(self, container, blob, snapshot=None):
+        return FakeBlobClient(self, container, blob, snapshot)
+
+    def get_user_delegation_key(self, key_start_time, key_expiry_time, **kwargs):
+        self.stats.count("get_user_delegation_key")
+        key = UserDelegationKey()
+        key.signed_oid = key.signed_tid = "00000000-0000-0000-0000-000000000000"
+        key.signed_start = key_start_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+        key.signed_expiry = key_expiry_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+        key.signed_service = "b"
+        key.signed_version = "2019-12-12"
+        key.value = base64.b64encode(b"fake-key").decode("ascii")
+        return key
+
+    def get_version(self, container_name, blob_name, snapshot=None):
+        container = self.get_container(container_name)
+        with self.lock:
+            if snapshot is None:
+                blob = container["blobs"].get(blob_name)
+            else:
+                blob = next((version for version in container["snapshots"].get(blob_name, []) if version.snapshot == snapshot), None)
+        if blob is None:
+            raise ResourceNotFoundError("blob not found")
+        return blob
+
+    def put(self, container_name, blob_name, data, overwrite=True, metadata=None, content_md5=None, last_modified=None):
+        container = self.get_container(container_name)
+        with self.lock:
+            if not overwrite and blob_name in container["blobs"]:
+                raise ResourceExistsError("blob exists")
+            self.snapshot_clock += timedelta(milliseconds=1)
+            blob = FakeBlob(container_name, blob_name, data, last_modified or self.snapshot_clock, metadata, content_md5)
+            container["blobs"][blob_name] = blob
+        return blob
+
+    def delete(self, container_name, blob_name, snapshot=None):
+        container = self.get_container(container_name)
+        with self.lock:
+            if snapshot is None:
+                if container["blobs"].pop(blob_name, None) is None:
+                    raise ResourceNotFoundError("blob not found")
+                return
+            versions = container["snapshots"].get(blob_name, [])
+            remaining = [version for version in versions if version.snapshot != snapshot]
+            if len(remaining) == len(versions):
+                raise ResourceNotFoundError("snapshot not found")
+            container["snapshots"][blob_name] = remaining
+
+async def async_iter(items):
+    for item in items:
+        yield item
+
+class AsyncFakeItemPaged:
+    # Pager of the async SDK over a fake listing, pages and their items are iterated with async for
+    def __init__(self, item_paged):
+        self.item_paged = item_paged
+
+    def by_page(self, continuation_token=None):
+        return async_iter(async_iter(page) for page in self.item_paged.by_page(continuation_token=continuation_token))
+
+    def __aiter__(self):
+        return async_iter(self.item_paged)
+
+class AsyncFakeBlobClient:
+    def __init__(self, blob_client):
+        self.blob_client = blob_client
+
+    async def create_snapshot(self, **kwargs):
+        return self.blob_client.create_snapshot(**kwargs)
+
+class AsyncFakeContainerClient:
+    def __init__(self, container_client):
+        self.container_client = container_client
+        self.container_name = container_client.container_name
+
+    def get_blob_client(self, blob, snapshot=None):
+        return AsyncFakeBlobClient(self.container_client.get_blob_client(blob, snapshot))
+
+    def list_blobs(self, **kwargs):
+        return AsyncFakeItemPaged(self.container_client.list_blobs(**kwargs))
+
+class AsyncFakeBlobServiceClient:
+    # Subset of azure.storage.blob.aio.BlobServiceClient used by shared_code/async_reconcile.py, backed by a fake account
+    def __init__(self, account):
+        self.account = account
+
+    def list_containers(self, **kwargs):
+        return async_iter(self.account.list_containers(**kwargs))
+
+    def get_container_client(self, container):
+        return AsyncFakeContainerClient(self.account.get_container_client(container))
+
+class FakeQueueClient:
+    def __init__(self, queue_name, stats):
+        self.queue_name = queue_name
+        self.stats = stats
+        self.lock = threading.Lock()
+        self.messages = []
+
+    def create_queue(self, **kwargs):
+        self.stats.count("create_queue")
+
+    def send_message(self, content, **kwargs):
+        self.stats.count("put_message")
+        with self.lock:
+            self.messages.append(content)
+
+    def drain(self):
+        with self.lock:
+            messages = self.messages
+            self.messages = []
+        return messages
+
+class FakeResponse:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.body = body or {}
+        self.content = str(self.body).encode("utf-8")
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        pass
+
+class StubAdfSession:
+    # Stands in for the requests session of shared_code/adf_client.py: MSI token endpoint, ADFv2 createRun and
+    # queryPipelineRuns. Runs have status Succeeded unless a test sets another status in statuses.
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.runs = []
+        self.statuses = {}
+        self.lock = threading.Lock()
+
+    def get(self, url, params=None, headers=None, **kwargs):
+        self.stats.count("msi_token")
+        expires_on = (datetime.now(timezone.utc) + timedelta(hours=8)).timestamp()
+        return FakeResponse(200, {"access_token": "token", "expires_on": str(expires_on)})
+
+    def post(self, url, headers=None, json=None, **kwargs):
+        if "/queryPipelineRuns" in url:
+            return self.query_runs(json)
+        self.stats.count("adf_create_run")
+        with self.lock:
+            self.runs.append(json)
+            run_id = "run{}".format(len(self.runs))
+        return FakeResponse(200, {"runId": run_id})
+
+    def query_runs(self, body):
+        self.stats.count("adf_query_runs")
+        run_ids = body["filters"][0]["values"]
+        with self.lock:
+            known = set("run{}".format(index + 1) for index in range(len(self.runs)))
+        return FakeResponse(200, {"value": [{"runId": run_id, "status": self.statuses.get(run_id, "Succeeded"), "durationInMs": 1000}
+                                            for run_id in run_ids if run_id in known]})
+
+class FakeStorageRegistry:
+    # All fake accounts of a benchmark, resolves SAS urls of server-side copies to the stored version
+
+    def __init__(self):
+        self.stats = RequestStats()
+        self.accounts = {}
+
+    def resolve(self, url):
+        parsed = urlparse(url)
+        account = self.accounts[parsed.netloc.split(".")[0]]
+        container_name, blob_name = unquote(parsed.path).lstrip("/").split("/", 1)
+        snapshot = parse_qs(parsed.query).get("snapshot", [None])[0]
+        return account.get_version(container_name, blob_name, snapshot)
+
+def listing_key(item):
+    # Listing order: snapshots of a blob oldest first, then the blob itself
+    snapshot = getattr(item, "snapshot", None)
+    return (item.name, 0, snapshot) if snapshot is not None else (item.name, 1, "")
+
+def content_md5(data):
+    return bytearray(hashlib.md5(data).digest())
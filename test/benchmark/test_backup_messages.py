@@ -0,0 +1,62 @@
+import base64
+import json
+import random
+import string
+
+from conftest import app_module
+
+def requests_of(names, snapshot="2020-06-01T10:11:12.1234567Z"):
+    backup_messages = app_module("shared_code.backup_messages")
+    return [backup_messages.BackupRequest("data", name, "0x8D{:012X}".format(index), snapshot if index % 2 else None)
+            for index, name in enumerate(names)]
+
+def keys(requests):
+    return [(request.container, request.blob_name, request.etag, request.snapshot) for request in requests]
+
+def round_trip(requests, compress):
+    backup_messages = app_module("shared_code.backup_messages")
+    messages = list(backup_messages.encode_messages("data", requests, compress))
+    for message in messages:
+        payload = message.encode("utf-8")
+        assert len(payload) <= backup_messages.MAX_PAYLOAD_BYTES
+        # the queue client sends the payload base64 encoded
+        assert len(base64.b64encode(payload)) <= backup_messages.MAX_QUEUE_MESSAGE_BYTES
+    decoded = [request for message in messages for request in backup_messages.decode_message(message)]
+    assert keys(decoded) == keys(requests)
+    return messages
+
+def test_round_trip_special_characters():
+    names = ['quote"in name.csv', "back\\slash\\folder.csv", "both\\\"mixed'.csv", "unicode/ümlaut ✓.csv", "tab\tand newline\n.csv"]
+    for compress in (False, True):
+        assert len(round_trip(requests_of(names), compress)) == 1
+
+def test_messages_split_at_payload_limit():
+    # long multi-byte names fill many messages, every message stays within the limit
+    names = ["folder/ü{}/{}.csv".format(index, "x" * 300) for index in range(2000)]
+    messages = round_trip(requests_of(names), False)
+    assert len(messages) > 1
+    backup_messages = app_module("shared_code.backup_messages")
+    assert all(len(message.encode("utf-8")) > backup_messages.MAX_PAYLOAD_BYTES * 0.9 for message in messages[:-1])
+
+def test_compressed_messages():
+    # similar names compress well, far fewer messages are sent than uncompressed
+    names = ["ingest/2020/06/01/part-{:05d}.parquet".format(index) for index in range(20000)]
+    compressed = round_trip(requests_of(names), True)
+    assert len(compressed) * 4 < len(round_trip(requests_of(names), False))
+    assert all("z" in json.loads(message) for message in compressed)
+
+def test_compressed_messages_split_when_compression_is_low():
+    # random names compress worse than the packing limit assumes, batches are split until they fit
+    rng = random.Random(1)
+    names = ["".join(rng.choice(string.ascii_letters + string.digits) for _ in range(200)) for _ in range(3000)]
+    backup_messages = app_module("shared_code.backup_messages")
+    uncompressed_bytes = sum(backup_messages.entry_size(request) for request in requests_of(names))
+    assert len(round_trip(requests_of(names), True)) > uncompressed_bytes / backup_messages.MAX_UNCOMPRESSED_BYTES + 1
+
+def test_decode_single_blob_message_of_earlier_versions():
+    backup_messages = app_module("shared_code.backup_messages")
+    raw = json.dumps({"container": "data", "blob_name": 'folder/a"b.csv', "etag": "\"0x8D800000000001\""})
+    assert keys(backup_messages.decode_message(raw)) == [("data", 'folder/a"b.csv', "0x8D800000000001", None)]
+
+    raw = json.dumps({"container": "data", "blob_name": "a.csv", "etag": "0x8D800000000001", "snapshot": "2020-06-01T10:11:12.1234567Z"})
+    assert keys(backup_messages.decode_message(raw)) == [("data", "a.csv", "0x8D800000000001", "2020-06-01T10:11:12.1234567Z")]
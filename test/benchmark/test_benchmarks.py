@@ -0,0 +1,251 @@
+import asyncio
+
+import azure.functions as func
+import pytest
+
+from conftest import QUEUE_NAME, app_module, call_json
+from fake_storage import AsyncFakeBlobServiceClient
+
+def copy_messages(storage):
+    # Feeds all backup request messages of the queue to the queue-triggered copy function
+    main = app_module("QueueCreateBlobBackupADFv2").main
+    messages = storage.queues["queuesnapshotmetadata"].drain()
+    for message in messages:
+        main(func.QueueMessage(body=message.encode("utf-8")))
+    return len(messages)
+
+def count_backups(storage, container_name):
+    naming = app_module("shared_code.backup_naming")
+    return sum(1 for name in storage.backup.containers[container_name + "bak"]["blobs"] if naming.parse_backup_name(name) is not None)
+
+def test_producer_cold_and_warm(storage, benchmark):
+    changed = storage.build_datalake()
+    main = app_module("HttpSnapshotIncBackupContainerProducer").main
+
+    # first run has no snapshot index and checks the snapshots of every blob
+    cold = benchmark("producer cold index", call_json, main, {"container": "container0"})
+    assert cold["backup_requests"] == changed["container0"]
+    # index is bootstrapped from one listing including snapshots, not from a listing per blob
+    assert storage.stats.requests["list_blobs"] < cold["blobs_listed"] / 100
+
+    # second run finds all blobs in the index
+    warm = benchmark("producer warm index", call_json, main, {"container": "container0"})
+    assert warm["backup_requests"] == 0
+    assert warm["blobs_unchanged"] == warm["blobs_listed"]
+    assert warm["metrics"]["function"] == "HttpSnapshotIncBackupContainerProducer"
+
+def test_producer_prefix(storage, benchmark):
+    storage.build_datalake()
+    main = app_module("HttpSnapshotIncBackupContainerProducer").main
+    call_json(main, {"container": "container0"})
+
+    storage.source.put("container0", "folder1/new.csv", b"new")
+    result = benchmark("producer one prefix", call_json, main, {"container": "container0", "prefix": "folder1/"})
+    assert result["backup_requests"] == 1
+
+def test_producer_prefix_not_recursive(storage):
+    storage.build_datalake()
+    main = app_module("HttpSnapshotIncBackupContainerProducer").main
+    call_json(main, {"container": "container0", "prefix": "folder1/", "recursive": "false"})
+
+    # only blobs directly in the folder are listed, not those of its subfolders or of other folders
+    storage.source.put("container0", "folder1/new.csv", b"new")
+    storage.source.put("container0", "folder1/sub/new.csv", b"new")
+    storage.source.put("container0", "folder2/new.csv", b"new")
+    assert call_json(main, {"container": "container0", "prefix": "folder1/", "recursive": "false"})["backup_requests"] == 1
+
+def test_producer_prefix_index_shards(storage):
+    storage.build_datalake()
+    main = app_module("HttpSnapshotIncBackupContainerProducer").main
+    call_json(main, {"container": "container0", "prefix": "folder1/"})
+    call_json(main, {"container": "container0", "prefix": "folder2/"})
+
+    # each prefix has its own index, the second run did not overwrite the index of the first
+    storage.stats.reset()
+    assert call_json(main, {"container": "container0", "prefix": "folder1/"})["backup_requests"] == 0
+    assert "list_blobs" in storage.stats.requests and storage.stats.requests["snapshot_blob"] == 0
+
+    storage.source.put("container0", "folder2/new.csv", b"new")
+    assert call_json(main, {"container": "container0", "prefix": "folder2/"})["backup_requests"] == 1
+
+def test_producer_retries_failed_queue_send(storage):
+    storage.build_datalake()
+    main = app_module("HttpSnapshotIncBackupContainerProducer").main
+    call_json(main, {"container": "container0", "prefix": "folder1/"})
+    storage.source.put("container0", "folder1/new.csv", b"new")
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("queue unavailable")
+    storage.queues[QUEUE_NAME].send_message = fail
+    with pytest.raises(RuntimeError):
+        call_json(main, {"container": "container0", "prefix": "folder1/"})
+
+    # index was not saved, the retry requests the backup of the new blob again
+    del storage.queues[QUEUE_NAME].send_message
+    assert call_json(main, {"container": "container0", "prefix": "folder1/"})["backup_requests"] == 1
+
+def test_reconciliation_sync(storage, benchmark):
+    changed = storage.build_datalake()
+    main = app_module("HttpSnapshotIncBackupStorageReconciliation").main
+
+    result = benchmark("reconciliation sync", call_json, main, {})
+    assert result["backup_requests"] == sum(changed.values())
+
+    # second run does not snapshot the new versions again, their backups are still pending
+    result = benchmark("reconciliation sync repeated", call_json, main, {})
+    assert result["backup_requests"] == sum(changed.values())
+
+def test_reconciliation_async(storage, benchmark):
+    changed = storage.build_datalake()
+    async_reconcile = app_module("shared_code.async_reconcile")
+    backup_queue_module = app_module("shared_code.backup_queue")
+    client_source = AsyncFakeBlobServiceClient(storage.source)
+    client_backup = AsyncFakeBlobServiceClient(storage.backup)
+
+    def run():
+        backup_queue = backup_queue_module.BackupRequestQueue(backup_queue_module.get_queue_client())
+        result = asyncio.run(async_reconcile.reconcile_accounts_async(client_source, client_backup, backup_queue))
+        backup_queue.close()
+        return result
+    result = benchmark("reconciliation async", run)
+    assert result.containers == len(changed)
+    assert result.snapshots_created == result.backups_requested == sum(changed.values())
+
+    # repeated run finds the snapshots, the backups are still pending
+    result = run()
+    assert result.snapshots_created == 0
+    assert result.backups_requested == sum(changed.values())
+
+def test_reconciliation_numbered_names(storage):
+    # backup of file1.csv is listed after the backups of file10.csv to file1999.csv, beyond the reorder window of the merge-join
+    storage.build_datalake(containers=1, blobs=3000, folders=1, change_ratio=0)
+    result = call_json(app_module("HttpSnapshotIncBackupStorageReconciliation").main, {})
+    assert result["backup_requests"] == 0
+
+def test_reconciliation_sharded(storage, benchmark):
+    changed = storage.build_datalake()
+    main = app_module("HttpSnapshotIncBackupStorageReconciliation").main
+    worker = app_module("QueueReconcilePartition").main
+
+    started = benchmark("reconciliation sharded coordinator", call_json, main, {"engine": "sharded"})
+
+    def run_partitions():
+        for message in storage.queues["queuereconcilepartitions"].drain():
+            worker(func.QueueMessage(body=message.encode("utf-8")))
+    benchmark("reconciliation sharded workers", run_partitions)
+
+    result = call_json(main, {"engine": "sharded", "run_id": started["run_id"]})
+    assert result["status"] == "ok"
+    assert result["partitions_finished"] == started["partitions"]
+    assert result["backup_requests"] == sum(changed.values())
+
+class RetriedQueueMessage(func.QueueMessage):
+    # Queue message delivered for the given attempt, the host sets dequeue_count
+    def __init__(self, body, dequeue_count):
+        super().__init__(body=body)
+        self._dequeue_count = dequeue_count
+
+    @property
+    def dequeue_count(self):
+        return self._dequeue_count
+
+def run_partition_queue(storage):
+    worker = app_module("QueueReconcilePartition").main
+    while storage.queues["queuereconcilepartitions"].messages:
+        for message in storage.queues["queuereconcilepartitions"].drain():
+            worker(func.QueueMessage(body=message.encode("utf-8")))
+
+def test_reconciliation_sharded_continues_partitions(storage, monkeypatch):
+    changed = storage.build_datalake()
+    main = app_module("HttpSnapshotIncBackupStorageReconciliation").main
+    # small pages and no time budget, every partition is continued after each page
+    monkeypatch.setattr(app_module("shared_code.listing"), "LIST_BLOBS_PAGE_SIZE", 50)
+    monkeypatch.setenv("par_reconcile_time_budget_seconds", "0")
+
+    started = call_json(main, {"engine": "sharded"})
+    run_partition_queue(storage)
+    result = call_json(main, {"engine": "sharded", "run_id": started["run_id"]})
+    assert result["status"] == "ok"
+    assert result["partitions_finished"] == started["partitions"]
+    assert result["backup_requests"] == sum(changed.values())
+
+def test_reconciliation_sharded_reports_failed_partitions(storage, monkeypatch):
+    storage.build_datalake()
+    main = app_module("HttpSnapshotIncBackupStorageReconciliation").main
+    started = call_json(main, {"engine": "sharded"})
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("listing failed")
+    monkeypatch.setattr(app_module("shared_code.sharding"), "reconcile_container", fail)
+    worker = app_module("QueueReconcilePartition").main
+    messages = storage.queues["queuereconcilepartitions"].drain()
+    for message in messages:
+        with pytest.raises(RuntimeError):
+            worker(RetriedQueueMessage(message.encode("utf-8"), 5))
+
+    result = call_json(main, {"engine": "sharded", "run_id": started["run_id"]})
+    assert result["status"] == "failed"
+    assert result["partitions_failed"] == started["partitions"]
+    assert result["failed_partitions"][0]["error"] == "listing failed"
+
+def test_reconciliation_sharded_last_attempt_continues(storage, monkeypatch):
+    changed = storage.build_datalake()
+    main = app_module("HttpSnapshotIncBackupStorageReconciliation").main
+    monkeypatch.setattr(app_module("shared_code.listing"), "LIST_BLOBS_PAGE_SIZE", 50)
+    monkeypatch.setenv("par_reconcile_time_budget_seconds", "0")
+    started = call_json(main, {"engine": "sharded"})
+
+    # last delivery of every partition runs out of time, the partitions are continued and not failed
+    worker = app_module("QueueReconcilePartition").main
+    for message in storage.queues["queuereconcilepartitions"].drain():
+        worker(RetriedQueueMessage(message.encode("utf-8"), 5))
+    assert storage.queues["queuereconcilepartitions"].messages
+    result = call_json(main, {"engine": "sharded", "run_id": started["run_id"]})
+    assert result["status"] == "running"
+    assert result["partitions_failed"] == 0
+
+    run_partition_queue(storage)
+    result = call_json(main, {"engine": "sharded", "run_id": started["run_id"]})
+    assert result["status"] == "ok"
+    assert result["partitions_finished"] == started["partitions"]
+    assert result["backup_requests"] == sum(changed.values())
+
+def test_queue_copy_direct(storage, benchmark):
+    changed = storage.build_datalake()
+    call_json(app_module("HttpSnapshotIncBackupStorageReconciliation").main, {})
+    backups_before = count_backups(storage, "container0")
+
+    messages = benchmark("queue copy direct", copy_messages, storage)
+    assert messages > 0
+    assert count_backups(storage, "container0") == backups_before + changed["container0"]
+
+def test_queue_copy_adf(storage, benchmark, monkeypatch):
+    changed = storage.build_datalake()
+    monkeypatch.setattr(app_module("QueueCreateBlobBackupADFv2"), "USING_DIRECT_COPY", False)
+    call_json(app_module("HttpSnapshotIncBackupStorageReconciliation").main, {})
+
+    benchmark("queue copy adf", copy_messages, storage)
+    assert len(storage.adf.runs) == sum(changed.values())
+
+def test_track_backup_copies(storage, monkeypatch):
+    changed = storage.build_datalake()
+    monkeypatch.setattr(app_module("QueueCreateBlobBackupADFv2"), "USING_DIRECT_COPY", False)
+    call_json(app_module("HttpSnapshotIncBackupStorageReconciliation").main, {})
+    copy_messages(storage)
+    runs = len(storage.adf.runs)
+    assert runs == sum(changed.values())
+
+    copy_tracker = app_module("shared_code.copy_tracker")
+    storage.adf.statuses.update({"run1": "Failed", "run2": "InProgress"})
+    invocation = app_module("shared_code.metrics").InvocationMetrics("TimerTrackBackupCopies")
+    result = copy_tracker.track_copies()
+    assert result == {"in_flight": 1, "succeeded": runs - 2, "failed": 1, "cancelled": 0, "lost": 0}
+    # run ids are queried in batches, not one request per run
+    assert storage.stats.requests["adf_query_runs"] == -(-runs // copy_tracker.RUN_QUERY_BATCH_SIZE)
+    assert invocation.counters["adf.run_failed"] == 1
+    assert invocation.histograms["adf.copy"].count == runs - 1
+
+    # only the record of the running copy is left
+    storage.adf.statuses["run2"] = "Succeeded"
+    assert copy_tracker.track_copies()["succeeded"] == 1
+    assert copy_tracker.track_copies() == {"in_flight": 0, "succeeded": 0, "failed": 0, "cancelled": 0, "lost": 0}
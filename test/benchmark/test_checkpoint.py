@@ -0,0 +1,80 @@
+from collections import Counter
+
+from conftest import QUEUE_NAME, app_module, call_json
+
+def changed_blobs(storage):
+    # (container, blob) of the blobs modified after their latest snapshot
+    changed = set()
+    for container_name, container in storage.source.containers.items():
+        for blob_name, blob in container["blobs"].items():
+            snapshots = container["snapshots"].get(blob_name)
+            if not snapshots or snapshots[-1].etag != blob.etag:
+                changed.add((container_name, blob_name))
+    return changed
+
+def requested_blobs(storage):
+    decode_message = app_module("shared_code.backup_messages").decode_message
+    return Counter((request.container, request.blob_name) for message in storage.queues[QUEUE_NAME].drain() for request in decode_message(message))
+
+def incremental_run(time_budget):
+    main = app_module("HttpSnapshotIncBackupStorageReconciliation").main
+    return call_json(main, {"incremental": "true", "time_budget": str(time_budget)})
+
+def use_file_checkpoints(monkeypatch, tmp_path):
+    monkeypatch.setenv("par_checkpoint_store", "file:" + str(tmp_path))
+    return app_module("shared_code.checkpoint").FileCheckpointStore(str(tmp_path))
+
+def test_incremental_run_resumes_after_deadline(storage, monkeypatch, tmp_path):
+    storage.build_datalake(blobs=300, folders=3)
+    changed = changed_blobs(storage)
+    checkpoint_store = use_file_checkpoints(monkeypatch, tmp_path)
+    # no time budget, every run stops after the first page and the next run resumes from the checkpoint
+    monkeypatch.setattr(app_module("shared_code.listing"), "LIST_BLOBS_PAGE_SIZE", 100)
+
+    runs = 0
+    resumed_containers = []
+    while True:
+        result = incremental_run(0)
+        runs += 1
+        if result["status"] == "ok":
+            break
+        resumed_containers.append(checkpoint_store.load("_run")["resume_container"])
+        assert runs < 100
+
+    # both containers are listed in several runs, completed containers are not listed again
+    assert runs > 2
+    assert sorted(resumed_containers) == resumed_containers and set(resumed_containers) == {"container0", "container1"}
+    assert checkpoint_store.load("_run")["resume_container"] is None
+    # changed blobs are requested exactly once, pages starting between a snapshot and its blob do not create snapshots
+    assert requested_blobs(storage) == Counter(changed)
+    assert storage.stats.requests["snapshot_blob"] == len(changed)
+
+def test_incremental_run_skips_handled_blobs(storage, monkeypatch, tmp_path):
+    storage.build_datalake(blobs=300, folders=3)
+    changed = changed_blobs(storage)
+    checkpoint_store = use_file_checkpoints(monkeypatch, tmp_path)
+    assert incremental_run(240)["backup_requests"] == len(changed)
+
+    # blobs with snapshot and backup are in the digest, the pending backups are requested again
+    storage.queues[QUEUE_NAME].drain()
+    storage.stats.reset()
+    assert incremental_run(240)["backup_requests"] == len(changed)
+    assert storage.stats.requests["snapshot_blob"] == 0
+
+def test_complete_pass_drops_deleted_blobs(storage, monkeypatch, tmp_path):
+    storage.build_datalake(containers=1, blobs=300, folders=3, change_ratio=0)
+    checkpoint = app_module("shared_code.checkpoint")
+    checkpoint_store = use_file_checkpoints(monkeypatch, tmp_path)
+    incremental_run(240)
+    handled = checkpoint.load_container_checkpoint(checkpoint_store, "container0")
+    assert len(handled.digest) == 300 and len(handled.pass_digest) == 0
+
+    normalize_etag = app_module("shared_code.backup_naming").normalize_etag
+    deleted = {}
+    for blob_name in ["folder0/file{}.csv".format(index) for index in range(0, 30, 3)]:
+        deleted[blob_name] = normalize_etag(storage.source.containers["container0"]["blobs"][blob_name].etag)
+        storage.source.delete("container0", blob_name)
+    incremental_run(240)
+    handled = checkpoint.load_container_checkpoint(checkpoint_store, "container0")
+    assert len(handled.digest) == 290
+    assert not any(handled.is_handled(blob_name, etag) for blob_name, etag in deleted.items())
@@ -0,0 +1,70 @@
+import hashlib
+import random
+from datetime import datetime, timezone
+
+from conftest import app_module
+
+CHUNK_BYTES = 1024
+
+def put_version(storage, container_name, blob_name, data):
+    # New version of the blob with its snapshot, returns (snapshot id, name of its backup)
+    naming = app_module("shared_code.backup_naming")
+    blob = storage.source.put(container_name, blob_name, data)
+    snapshot = storage.source.next_snapshot_id()
+    storage.source.containers[container_name]["snapshots"].setdefault(blob_name, []).append(blob.snapshot_copy(snapshot))
+    return snapshot, naming.append_timestamp_etag(blob_name, blob.last_modified, naming.normalize_etag(blob.etag))
+
+def backup_delta(storage, blob_name, data):
+    delta_backup = app_module("shared_code.delta_backup")
+    snapshot, blob_name_backup = put_version(storage, "data", blob_name, data)
+    uploaded = delta_backup.backup_blob_delta(storage.source, storage.backup, "data", blob_name, blob_name_backup, len(data), snapshot)
+    return blob_name_backup, uploaded
+
+def chunk_names(storage):
+    delta_backup = app_module("shared_code.delta_backup")
+    return set(name for name in storage.backup.containers["databak"]["blobs"] if name.startswith(delta_backup.DELTA_CHUNK_PREFIX))
+
+def setup_containers(storage, monkeypatch):
+    monkeypatch.setenv("par_delta_chunk_bytes", str(CHUNK_BYTES))
+    storage.source.create_container("data")
+    storage.source.create_container("restored")
+    storage.backup.create_container("databak")
+
+def test_delta_backup_uploads_changed_chunks_and_restores(storage, monkeypatch):
+    delta_backup = app_module("shared_code.delta_backup")
+    setup_containers(storage, monkeypatch)
+    rng = random.Random(1)
+    # 8 full chunks and a partial one
+    first = rng.randbytes(8 * CHUNK_BYTES + 100)
+    second = first[:3 * CHUNK_BYTES] + rng.randbytes(CHUNK_BYTES) + first[4 * CHUNK_BYTES:]
+
+    blob_name_first, uploaded = backup_delta(storage, "big.bin", first)
+    assert uploaded == len(first)
+    assert len(chunk_names(storage)) == 9
+
+    # only the changed chunk is uploaded for the next version
+    blob_name_second, uploaded = backup_delta(storage, "big.bin", second)
+    assert uploaded == CHUNK_BYTES
+    assert len(chunk_names(storage)) == 10
+
+    for blob_name_backup, data in ((blob_name_first, first), (blob_name_second, second)):
+        blob_target = storage.source.get_blob_client("restored", "big.bin")
+        delta_backup.restore_delta_version(storage.backup, "databak", blob_name_backup, blob_target)
+        assert storage.source.containers["restored"]["blobs"]["big.bin"].data == data
+
+def test_restore_follows_dedup_reference_to_delta_manifest(storage, monkeypatch):
+    dedup = app_module("shared_code.dedup")
+    restore = app_module("shared_code.restore")
+    setup_containers(storage, monkeypatch)
+    data = random.Random(2).randbytes(4 * CHUNK_BYTES)
+    blob_name_target, _ = backup_delta(storage, "big.bin", data)
+
+    # later version with the same content is a reference to the manifest
+    _, blob_name_reference = put_version(storage, "data", "big.bin", data)
+    dedup.write_backup_reference(storage.backup, "databak", blob_name_reference, hashlib.md5(data).hexdigest(), blob_name_target)
+
+    plan = restore.plan_restore_from_backups(storage.backup, "data", "", datetime.now(timezone.utc))
+    assert [(item.blob_name_backup, item.dedup_ref) for item in plan] == [(blob_name_reference, blob_name_target)]
+    result = restore.RestoreResult()
+    assert restore.restore_item(storage.source, storage.backup, "data", "restored", plan[0], result) == len(data)
+    assert storage.source.containers["restored"]["blobs"]["big.bin"].data == data
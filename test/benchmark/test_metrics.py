@@ -0,0 +1,34 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from conftest import app_module
+
+def test_invocation_metrics_are_scoped_per_invocation():
+    metrics = app_module("shared_code.metrics")
+    shared_executor = ThreadPoolExecutor(max_workers=4)
+    started = threading.Barrier(2)
+    summaries = {}
+
+    def invocation(name, copies):
+        # invocations run at the same time and submit their work to the same executor
+        invocation_metrics = metrics.InvocationMetrics(name)
+        started.wait()
+
+        def copy():
+            with metrics.get_metrics().timer("copy.direct"):
+                metrics.get_metrics().count("copy.direct_bytes", 10)
+        futures = [shared_executor.submit(metrics.bind_context(copy)) for _ in range(copies)]
+        for future in futures:
+            future.result()
+        summaries[name] = invocation_metrics.summary()
+
+    threads = [threading.Thread(target=invocation, args=(name, copies)) for name, copies in (("first", 3), ("second", 5))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    shared_executor.shutdown()
+
+    assert summaries["first"]["counters"] == {"copy.direct_bytes": 30}
+    assert summaries["second"]["counters"] == {"copy.direct_bytes": 50}
+    assert summaries["second"]["latency_seconds"]["copy.direct"]["count"] == 5
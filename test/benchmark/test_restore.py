@@ -0,0 +1,32 @@
+from conftest import app_module
+
+def put_with_snapshot(storage, container_name, blob_name, data):
+    blob = storage.source.put(container_name, blob_name, data)
+    storage.source.containers[container_name]["snapshots"].setdefault(blob_name, []).append(blob.snapshot_copy(storage.source.next_snapshot_id()))
+    return blob
+
+def test_restore_into_target_container_copies_unchanged_blobs(storage):
+    restore = app_module("shared_code.restore")
+    storage.source.create_container("data")
+    put_with_snapshot(storage, "data", "folder/changed.csv", b"old")
+    put_with_snapshot(storage, "data", "folder/unchanged.csv", b"unchanged")
+    timestamp = storage.source.snapshot_clock
+    storage.source.put("data", "folder/changed.csv", b"new")
+    storage.source.put("data", "folder/created_later.csv", b"later")
+
+    result = restore.restore_point_in_time(storage.source, storage.backup, "data", "folder/", timestamp, container_name_target="restored")
+    assert result.failed == 0
+    restored = storage.source.containers["restored"]["blobs"]
+    assert {name: blob.data for name, blob in restored.items()} == {"folder/changed.csv": b"old", "folder/unchanged.csv": b"unchanged"}
+
+def test_restore_in_place_leaves_unchanged_blobs(storage):
+    restore = app_module("shared_code.restore")
+    storage.source.create_container("data")
+    put_with_snapshot(storage, "data", "changed.csv", b"old")
+    put_with_snapshot(storage, "data", "unchanged.csv", b"unchanged")
+    timestamp = storage.source.snapshot_clock
+    storage.source.put("data", "changed.csv", b"new")
+
+    result = restore.restore_point_in_time(storage.source, storage.backup, "data", "", timestamp)
+    assert (result.planned, result.current, result.restored) == (1, 1, 1)
+    assert storage.source.containers["data"]["blobs"]["changed.csv"].data == b"old"
@@ -0,0 +1,113 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+from conftest import app_module
+
+NOW = datetime(2020, 6, 30, 12, tzinfo=timezone.utc)
+
+def backup_names(storage, container_name_backup):
+    return set(storage.backup.containers[container_name_backup]["blobs"])
+
+def put_backup(storage, container_name_backup, blob_name, days_ago, etag, data=b"data", metadata=None):
+    naming = app_module("shared_code.backup_naming")
+    blob_name_backup = naming.append_timestamp_etag(blob_name, NOW - timedelta(days=days_ago), etag)
+    storage.backup.put(container_name_backup, blob_name_backup, data, metadata=metadata)
+    return blob_name_backup
+
+def test_select_expired_keep_last():
+    retention = app_module("shared_code.retention")
+    versions = [(NOW - timedelta(days=days), days) for days in range(10)]
+    assert sorted(retention.RetentionPolicy(keep_last=3).select_expired(versions, NOW)) == list(range(3, 10))
+
+def test_select_expired_keeps_latest_version():
+    retention = app_module("shared_code.retention")
+    versions = [(NOW - timedelta(days=days), days) for days in (100, 200)]
+    assert retention.RetentionPolicy(keep_last=0).select_expired(versions, NOW) == [200]
+
+def test_select_expired_daily_weekly_monthly():
+    retention = app_module("shared_code.retention")
+    # two versions per day for 90 days, the latest of each bucket is the one at 18:00
+    versions = [(datetime(2020, 6, 30, hour, tzinfo=timezone.utc) - timedelta(days=days), (days, hour))
+                for days in range(90) for hour in (6, 18)]
+    policy = retention.RetentionPolicy(keep_last=1, keep_daily_days=3, keep_weekly_weeks=2, keep_monthly_months=2)
+    expired = set(policy.select_expired(versions, NOW))
+    kept = set(item for _, item in versions) - expired
+
+    # last 3 days, the latest version of the days and weeks in the window and of May and June
+    assert {(0, 18), (1, 18), (2, 18)} <= kept
+    assert (0, 6) not in kept and (1, 6) not in kept
+    assert (30, 18) in kept and (31, 18) not in kept
+    assert all(hour == 18 for _, hour in kept)
+    assert (89, 18) in expired
+
+def test_prune_backups_keeps_reference_targets(storage):
+    retention = app_module("shared_code.retention")
+    dedup = app_module("shared_code.dedup")
+    storage.backup.create_container("cbak")
+
+    # oldest version is the target of a reference of the latest version, the version before is a plain backup
+    target = put_backup(storage, "cbak", "a.csv", 30, "0x1")
+    plain = put_backup(storage, "cbak", "a.csv", 20, "0x2")
+    reference = put_backup(storage, "cbak", "a.csv", 1, "0x3", b"", {dedup.DEDUP_REF_METADATA: target})
+    storage.backup.put("cbak", dedup.DEDUP_INDEX_PREFIX + "hash1", b"", metadata={dedup.DEDUP_TARGET_METADATA: target})
+
+    deleted = retention.prune_backups(storage.backup, "cbak", retention.RetentionPolicy(keep_last=1), NOW)
+    assert deleted == 1
+    assert backup_names(storage, "cbak") == {target, reference, dedup.DEDUP_INDEX_PREFIX + "hash1"}
+    assert plain not in backup_names(storage, "cbak")
+
+def test_prune_backups_retires_content_index_target_first(storage):
+    retention = app_module("shared_code.retention")
+    dedup = app_module("shared_code.dedup")
+    storage.backup.create_container("cbak")
+
+    target = put_backup(storage, "cbak", "a.csv", 30, "0x1")
+    latest = put_backup(storage, "cbak", "a.csv", 1, "0x2")
+    marker = dedup.DEDUP_INDEX_PREFIX + "hash1"
+    storage.backup.put("cbak", marker, b"", metadata={dedup.DEDUP_TARGET_METADATA: target})
+    policy = retention.RetentionPolicy(keep_last=1)
+
+    # first run only removes the marker, a copy worker may still be writing a reference to the target
+    assert retention.prune_backups(storage.backup, "cbak", policy, NOW) == 0
+    assert backup_names(storage, "cbak") == {target, latest}
+    assert dedup.find_backup_with_content(storage.backup, "cbak", "hash1") is None
+
+    # reference written by such a worker keeps the target in the next run
+    reference = put_backup(storage, "cbak", "b.csv", 0, "0x3", b"", {dedup.DEDUP_REF_METADATA: target})
+    assert retention.prune_backups(storage.backup, "cbak", policy, NOW) == 0
+    assert target in backup_names(storage, "cbak")
+
+    # target is deleted once no reference and no marker refer to it
+    storage.backup.delete("cbak", reference)
+    assert retention.prune_backups(storage.backup, "cbak", policy, NOW) == 1
+    assert backup_names(storage, "cbak") == {latest}
+
+def test_find_backup_with_content_checks_target(storage):
+    dedup = app_module("shared_code.dedup")
+    storage.backup.create_container("cbak")
+    target = put_backup(storage, "cbak", "a.csv", 1, "0x1")
+    dedup.register_backup_content(storage.backup, "cbak", "hash1", target)
+    assert dedup.find_backup_with_content(storage.backup, "cbak", "hash1") == target
+
+    storage.backup.delete("cbak", target)
+    assert dedup.find_backup_with_content(storage.backup, "cbak", "hash1") is None
+
+def test_prune_backups_collects_unused_chunks(storage):
+    retention = app_module("shared_code.retention")
+    delta_backup = app_module("shared_code.delta_backup")
+    storage.backup.create_container("cbak")
+
+    def put_manifest(days_ago, etag, chunks):
+        manifest = json.dumps({"v": 1, "size": 0, "chunk_size": 1, "chunks": chunks})
+        return put_backup(storage, "cbak", "big.bin", days_ago, etag, manifest.encode("utf-8"), {delta_backup.DELTA_MANIFEST_METADATA: "1"})
+
+    put_manifest(30, "0x1", ["c1", "c2"])
+    latest = put_manifest(1, "0x2", ["c2", "c3"])
+    old = NOW - timedelta(days=30)
+    for chunk in ("c1", "c2", "c3"):
+        storage.backup.put("cbak", delta_backup.get_chunk_name(chunk), b"chunk", last_modified=old)
+    # unused chunk within the grace period, its manifest may not be written yet
+    storage.backup.put("cbak", delta_backup.get_chunk_name("c4"), b"chunk", last_modified=NOW - timedelta(hours=1))
+
+    assert retention.prune_backups(storage.backup, "cbak", retention.RetentionPolicy(keep_last=1), NOW) == 1
+    assert backup_names(storage, "cbak") == {latest} | set(delta_backup.get_chunk_name(chunk) for chunk in ("c2", "c3", "c4"))